@@ -0,0 +1,92 @@
+"""
+Micro-benchmark of the memoize key builder, run from the repository root:
+
+    python benchmarks/cache_key.py
+
+Compares the stock Flask-Caching key builder with ResourceCache's on the
+argument shapes used by our resources, then a full memoized hit.
+"""
+
+import importlib.util
+import os
+import sys
+import timeit
+
+from flask import Flask
+from flask_caching import Cache
+
+# Load utils without importing the salesmonkey package (needs settings.cfg)
+spec = importlib.util.spec_from_file_location(
+    "salesmonkey_utils",
+    os.path.join(os.path.dirname(__file__), "..", "salesmonkey", "utils.py"),
+)
+utils = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(utils)
+
+NUMBER = 20000
+
+
+def make_resource(cache):
+    class ItemDetail:
+        @cache.memoize(timeout=60)
+        def get(self, name):
+            return {"name": name}
+
+        @cache.memoize(timeout=60)
+        def list(self, item_group=None, **kwargs):
+            return [item_group]
+
+    return ItemDetail
+
+
+def bench(label, cache, config):
+    app = Flask(label)
+    app.config.update(config)
+    cache.init_app(app)
+    Resource = make_resource(cache)
+    resource = Resource()
+
+    with app.app_context():
+        get_key = Resource.get.make_cache_key
+        list_key = Resource.list.make_cache_key
+        resource.get("BIERE-001")
+
+        results = {
+            "key positional": timeit.timeit(
+                lambda: get_key(Resource.get.uncached, resource, "BIERE-001"),
+                number=NUMBER,
+            ),
+            "key keyword": timeit.timeit(
+                lambda: list_key(
+                    Resource.list.uncached, resource, item_group="Bières du Singe"
+                ),
+                number=NUMBER,
+            ),
+            "memoized hit": timeit.timeit(
+                lambda: resource.get("BIERE-001"), number=NUMBER
+            ),
+        }
+
+    for name, elapsed in results.items():
+        print(
+            "{0:<28} {1:<16} {2:8.2f} us/call".format(
+                label, name, elapsed / NUMBER * 1e6
+            )
+        )
+
+
+if __name__ == "__main__":
+    config = {"CACHE_TYPE": "simple"}
+    bench("flask_caching.Cache", Cache(), config)
+    bench("ResourceCache md5", utils.ResourceCache(), config)
+    bench(
+        "ResourceCache blake2b",
+        utils.ResourceCache(),
+        dict(config, CACHE_KEY_HASH="blake2b"),
+    )
+    bench(
+        "ResourceCache blake2b + L1",
+        utils.ResourceCache(),
+        dict(config, CACHE_KEY_HASH="blake2b", CACHE_L1_MAX_BYTES=1024 * 1024),
+    )
+    sys.exit(0)
@@ -50,12 +50,13 @@ from . import (
     dealers,
     delivery,
     shop,
+    webhooks,
 )
 
 from .erpnext import erp_client
 
 api_specs.init_app(app)
+session.init_app(app)
 api_v1.init_app(app)
 login_manager.init_app(app)
 cache.init_app(app)
-session.init_app(app)
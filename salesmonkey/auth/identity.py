@@ -0,0 +1,56 @@
+from flask import g
+from flask_login import current_user
+
+from erpnext_client.documents import ERPContact, ERPCustomer, ERPDynamicLink
+
+from salesmonkey import cache
+
+from ..erpnext import erp_client
+
+import logging
+
+LOGGER = logging.getLogger(__name__)
+
+
+@cache.memoize(timeout=60 * 60)
+def get_customer_for_user(username):
+    """
+    Resolve the ERP Customer of a user through its Contact and Dynamic Link.
+    Returns None if the user has no customer yet.
+    """
+    try:
+        contact = erp_client.query(ERPContact).first(
+            filters=[["Contact", "user", "=", username]], erp_fields=["name"]
+        )
+
+        link = erp_client.query(ERPDynamicLink).first(
+            filters=[
+                ["Dynamic Link", "parenttype", "=", "Contact"],
+                ["Dynamic Link", "parent", "=", contact["name"]],
+                ["Dynamic Link", "parentfield", "=", "links"],
+            ],
+            erp_fields=["name", "link_name", "parent", "parenttype"],
+            parent="Contact",
+        )
+
+        return erp_client.query(ERPCustomer).first(
+            filters=[["Customer", "name", "=", link["link_name"]]]
+        )
+    except (ERPContact.DoesNotExist, ERPDynamicLink.DoesNotExist):
+        return None
+    except ERPCustomer.DoesNotExist:
+        return None
+
+
+def invalidate_customer_for_user(username):
+    cache.delete_memoized(get_customer_for_user, username)
+
+
+def current_customer():
+    """
+    Customer of the logged in user, resolved once per request
+    """
+    if "customer" not in g:
+        g.customer = get_customer_for_user(current_user.username)
+
+    return g.customer
@@ -1,3 +1,6 @@
+import time
+
+from flask import session
 from flask_login import UserMixin
 from .manager import login_manager
 
@@ -19,15 +22,71 @@ from erpnext_client.schemas import ERPUserSchema
 
 from erpnext_client.documents import ERPUser
 
+from salesmonkey import app
+
 from ..erpnext import erp_client
+from ..utils import LRUCache
 
 import logging
 
 LOGGER = logging.getLogger(__name__)
 
+USER_CACHE_TTL = app.config.get("USER_CACHE_TTL", 60 * 15)
+
+# Users loaded recently by this worker, in front of the copy kept in session
+user_cache = LRUCache(
+    maxsize=app.config.get("USER_CACHE_SIZE", 1024), ttl=USER_CACHE_TTL
+)
+
+
+def remember_user(user):
+    """
+    Cache a user so next requests identify it without calling the ERP
+    """
+    user_info = {
+        "username": user.username,
+        "email": user.email,
+        "first_name": user.first_name,
+        "last_name": user.last_name,
+        "cached_at": time.time(),
+    }
+    user_cache.set(user.get_id(), user_info)
+    session["user_info"] = user_info
+
+
+def forget_user(user_id):
+    user_cache.delete(user_id)
+    session.pop("user_info", None)
+
+
+def _get_cached_user_info(user_id):
+    user_info = user_cache.get(user_id)
+    if user_info is not None:
+        return user_info
+
+    user_info = session.get("user_info")
+    if (
+        user_info is not None
+        and user_info["email"] == user_id
+        and user_info["cached_at"] + USER_CACHE_TTL > time.time()
+    ):
+        user_cache.set(user_id, user_info)
+        return user_info
+
+    return None
+
 
 @login_manager.user_loader
 def load_user(user_id):
+    user_info = _get_cached_user_info(user_id)
+    if user_info is not None:
+        return User(
+            username=user_info["username"],
+            email=user_info["email"],
+            first_name=user_info["first_name"],
+            last_name=user_info["last_name"],
+        )
+
     try:
         erp_user = erp_client.query(ERPUser).get(
             user_id, fields=["email", "first_name", "last_name"]
@@ -35,9 +94,12 @@ def load_user(user_id):
     except ERPUser.DoesNotExist:
         return None
 
-    return User(
+    user = User(
         username=user_id,
         email=erp_user["email"],
         first_name=erp_user["first_name"],
         last_name=erp_user["last_name"],
     )
+    remember_user(user)
+
+    return user
@@ -11,8 +11,9 @@ from flask_apispec import FlaskApiSpec, marshal_with, MethodResource, use_kwargs
 
 from .schemas import UserSchema
 
-from .models import User
-from flask_login import login_user, logout_user
+from .identity import invalidate_customer_for_user
+from .models import User, forget_user, remember_user
+from flask_login import current_user, login_user, logout_user
 from flask_login import login_required
 
 from ..erpnext import erp_client
@@ -232,6 +233,7 @@ api_v1.register("/customer/contact", CustomerContact)
 class LogoutManager(MethodResource):
     @login_required
     def get(self):
+        forget_user(current_user.get_id())
         logout_user()
 
         return True
@@ -407,10 +409,16 @@ class AuthWith(MethodResource):
         )
 
         if login_user(user):
+            remember_user(user)
+
             # Create ERP Contact and Customer
             contact, customer = self._get_or_create_contact_and_customer_for_user(user)
-            session["contact"] = contact
-            session["customer"] = customer
+            # Only their names are needed later on, keep the session small
+            session["contact"] = {"name": contact["name"]}
+            session["customer"] = {"name": customer["name"]}
+
+            # Customer may have just been (re)provisioned
+            invalidate_customer_for_user(user.username)
 
             return user
 
@@ -12,6 +12,7 @@ from erpnext_client.documents import ERPItem, ERPWebsiteSlideshow
 
 from ..erpnext import erp_client
 from ..rest import api_v1
+from ..utils import doc_tag
 
 from salesmonkey import cache
 
@@ -23,7 +24,7 @@ class BeerList(MethodResource):
     """
 
     @use_kwargs({"item_group": fields.Str()})
-    @cache.memoize(timeout=60)
+    @cache.memoize(timeout=60 * 60, stale_ttl=60 * 10, tags=[doc_tag("Item")])
     def get(self, item_group=None):
         item_group = item_group or "Bières du Singe"
 
@@ -47,7 +48,7 @@ class BeerList(MethodResource):
         return items
 
 
-api_v1.register("/beers/", BeerList)
+api_v1.register("/beers/", BeerList, session=False)
 
 
 class BeerItemSchema(ERPItemSchema):
@@ -102,4 +103,4 @@ class BeerDetails(MethodResource):
         return item
 
 
-api_v1.register("/beers/<slug>", BeerDetails)
+api_v1.register("/beers/<slug>", BeerDetails, session=False)
@@ -9,6 +9,7 @@ from webargs.flaskparser import use_args
 from ..rest import api_v1
 
 from ..erpnext import erp_client
+from ..fanout import fan_out
 
 from erpnext_client.schemas import ERPItemSchema
 
@@ -23,43 +24,41 @@ class ItemList(MethodResource):
     def get(self, **kwargs):
         item_group = kwargs.get("item_group", "")
 
-        items_no_variant = erp_client.query(ERPItem).list(
-            erp_fields=[
-                "name",
-                "description",
-                "item_code",
-                "total_projected_qty",
-                "web_long_description",
-                "standard_rate",
-                "thumbnail",
-            ],
-            filters=[
-                ["Item", "show_in_website", "=", "1"],
-                ["Item", "has_variants", "=", "0"],
-                ["Website Item Group", "item_group", "=", item_group],
-            ],
-        )
+        erp_fields = [
+            "name",
+            "description",
+            "item_code",
+            "total_projected_qty",
+            "web_long_description",
+            "standard_rate",
+            "thumbnail",
+        ]
 
-        # Items with variants
-        items_variants = erp_client.query(ERPItem).list(
-            erp_fields=[
-                "name",
-                "description",
-                "item_code",
-                "total_projected_qty",
-                "web_long_description",
-                "standard_rate",
-                "thumbnail",
-            ],
-            filters=[
-                ["Item", "show_variant_in_website", "=", "1"],
-                ["Website Item Group", "item_group", "=", item_group],
-            ],
+        # Both lists are independent, fetch them at once
+        results = fan_out(
+            {
+                "no_variant": lambda: erp_client.query(ERPItem).list(
+                    erp_fields=erp_fields,
+                    filters=[
+                        ["Item", "show_in_website", "=", "1"],
+                        ["Item", "has_variants", "=", "0"],
+                        ["Website Item Group", "item_group", "=", item_group],
+                    ],
+                ),
+                # Items with variants
+                "variants": lambda: erp_client.query(ERPItem).list(
+                    erp_fields=erp_fields,
+                    filters=[
+                        ["Item", "show_variant_in_website", "=", "1"],
+                        ["Website Item Group", "item_group", "=", item_group],
+                    ],
+                ),
+            }
         )
 
-        items = items_no_variant + items_variants
+        items = results["no_variant"] + results["variants"]
 
         return items
 
 
-api_v1.register("/brewshop/items/", ItemList)
+api_v1.register("/brewshop/items/", ItemList, session=False)
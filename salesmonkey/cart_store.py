@@ -0,0 +1,162 @@
+import json
+
+from salesmonkey import app
+
+from .store import get_redis
+
+# Add to a line quantity, removing the line when it drops to zero. An
+# increase taking the line above ARGV[5] (when set) is refused: the line is
+# left unchanged and 0 is returned with its quantity.
+_INCREMENT_LINE = """
+local current = tonumber(redis.call('HGET', KEYS[1], ARGV[1]) or '0')
+local delta = tonumber(ARGV[2])
+local qty = current + delta
+if delta > 0 and ARGV[5] ~= '' and qty > tonumber(ARGV[5]) then
+    return {current, 0}
+end
+if qty <= 0 then
+    redis.call('HDEL', KEYS[1], ARGV[1])
+    redis.call('HDEL', KEYS[2], ARGV[1])
+    qty = 0
+else
+    redis.call('HSET', KEYS[1], ARGV[1], qty)
+    redis.call('HSET', KEYS[2], ARGV[1], ARGV[3])
+end
+redis.call('PEXPIRE', KEYS[1], ARGV[4])
+redis.call('PEXPIRE', KEYS[2], ARGV[4])
+return {qty, 1}
+"""
+
+# Add many (code, quantity, details) lines at once, unless the merge marker
+# KEYS[3] shows they were already added
+_MERGE_LINES = """
+if not redis.call('SET', KEYS[3], 1, 'NX', 'PX', ARGV[1]) then
+    return 0
+end
+for i = 2, #ARGV, 3 do
+    local qty = redis.call('HINCRBY', KEYS[1], ARGV[i], ARGV[i + 1])
+    if qty <= 0 then
+        redis.call('HDEL', KEYS[1], ARGV[i])
+        redis.call('HDEL', KEYS[2], ARGV[i])
+    else
+        redis.call('HSET', KEYS[2], ARGV[i], ARGV[i + 2])
+    end
+end
+redis.call('PEXPIRE', KEYS[1], ARGV[1])
+redis.call('PEXPIRE', KEYS[2], ARGV[1])
+return 1
+"""
+
+
+class CartStore:
+    """
+    Carts kept in Redis, one per owner: a hash of line quantities and a hash
+    of line details (name, warehouse, unit price) by item code. Every change
+    is a single atomic command on one line, so concurrent requests of the
+    same user never lose each other's updates.
+    """
+
+    def __init__(self, get_redis, prefix="cart:", ttl=60 * 60 * 24 * 30):
+        self.get_redis = get_redis
+        self.prefix = prefix
+        self.ttl = ttl
+        self._increment_line = None
+        self._merge_lines = None
+
+    def _keys(self, owner):
+        return (
+            "{0}{1}:qty".format(self.prefix, owner),
+            "{0}{1}:lines".format(self.prefix, owner),
+        )
+
+    @staticmethod
+    def _dump_line(name, warehouse, price):
+        return json.dumps([name, warehouse, price])
+
+    def lines(self, owner):
+        """
+        Return [(code, name, warehouse, quantity, price)] of a cart
+        """
+        qty_key, lines_key = self._keys(owner)
+        pipe = self.get_redis().pipeline(transaction=True)
+        pipe.hgetall(qty_key)
+        pipe.hgetall(lines_key)
+        quantities, details = pipe.execute()
+
+        lines = []
+        for code, quantity in quantities.items():
+            detail = details.get(code)
+            if detail is None:
+                continue
+            if isinstance(code, bytes):
+                code = code.decode("utf-8")
+            name, warehouse, price = json.loads(detail)
+            lines.append((code, name, warehouse, int(quantity), price))
+
+        return sorted(lines)
+
+    def increment(
+        self, owner, code, quantity, name, warehouse, price, max_quantity=None
+    ):
+        """
+        Add quantity (possibly negative) to a line. Returns (quantity,
+        added): the new quantity of the line, or its unchanged one and False
+        when adding would take it above max_quantity.
+        """
+        if self._increment_line is None:
+            self._increment_line = self.get_redis().register_script(_INCREMENT_LINE)
+
+        new_quantity, added = self._increment_line(
+            keys=self._keys(owner),
+            args=[
+                code,
+                int(quantity),
+                self._dump_line(name, warehouse, price),
+                self.ttl * 1000,
+                "" if max_quantity is None else int(max_quantity),
+            ],
+        )
+        return int(new_quantity), bool(added)
+
+    def merge(self, owner, lines, merge_id):
+        """
+        Add [(code, name, warehouse, quantity, price)] lines to a cart, in
+        one atomic step done once per merge_id: merging the same lines again
+        is a no-op. Returns whether the lines were added.
+        """
+        if self._merge_lines is None:
+            self._merge_lines = self.get_redis().register_script(_MERGE_LINES)
+
+        args = [self.ttl * 1000]
+        for code, name, warehouse, quantity, price in lines:
+            args += [code, int(quantity), self._dump_line(name, warehouse, price)]
+
+        return bool(
+            self._merge_lines(
+                keys=self._keys(owner)
+                + ("{0}{1}:merged:{2}".format(self.prefix, owner, merge_id),),
+                args=args,
+            )
+        )
+
+    def set(self, owner, code, quantity, name, warehouse, price):
+        """
+        Replace the quantity of a line, removing it when zero
+        """
+        qty_key, lines_key = self._keys(owner)
+        pipe = self.get_redis().pipeline(transaction=True)
+        if quantity > 0:
+            pipe.hset(qty_key, code, int(quantity))
+            pipe.hset(lines_key, code, self._dump_line(name, warehouse, price))
+        else:
+            pipe.hdel(qty_key, code)
+            pipe.hdel(lines_key, code)
+        pipe.pexpire(qty_key, self.ttl * 1000)
+        pipe.pexpire(lines_key, self.ttl * 1000)
+        pipe.execute()
+
+    def clear(self, owner):
+        self.get_redis().delete(*self._keys(owner))
+
+
+cart_store = CartStore(get_redis, ttl=app.config.get("CART_TTL", 60 * 60 * 24 * 30))
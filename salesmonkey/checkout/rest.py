@@ -27,6 +27,7 @@ from erpnext_client.documents import (
     ERPDynamicLink,
 )
 
+from ..auth.identity import current_customer
 from ..schemas import CartSchema, Cart, Item
 
 from flask_login import current_user
@@ -247,7 +248,7 @@ class SalesOrderStripePayment(PaymentStep):
     def validate(self, checkout_id):
         intent = stripe.PaymentIntent.retrieve(checkout_id)
 
-        customer = session.get("customer", None)
+        customer = current_customer()
         if customer is None:
             raise InvalidData("Session Error")
 
@@ -288,7 +289,7 @@ class SalesOrderSumUpPayment(PaymentStep):
 
     def validate(self, checkout_id):
         checkout = self.client.get_checkout(checkout_id)
-        customer = session.get("customer", None)
+        customer = current_customer()
         if customer is None:
             raise InvalidData("Session Error")
 
@@ -332,9 +333,8 @@ class SalesOrderPayment(MethodResource):
 
     @login_required
     def get(self, name):
-        customer = session.get("customer", None)
-
-        if not customer:
+        customer = current_customer()
+        if customer is None:
             raise NotFound
 
         try:
@@ -356,8 +356,8 @@ class SalesOrderPayment(MethodResource):
     @login_required
     @use_kwargs({"checkout_id": fields.String(required=True)})
     def post(self, name, **kwargs):
-        customer = session.get("customer", None)
-        if not customer:
+        customer = current_customer()
+        if customer is None:
             raise NotFound
 
         try:
@@ -0,0 +1,374 @@
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import click
+import geocoder
+
+from salesmonkey import app
+
+from ..store import get_redis
+from .storage import SQLiteStore
+
+LOGGER = logging.getLogger(__name__)
+
+
+def normalize_address(txt_address):
+    """
+    Key of an address in the store: lower case, single spaced, no dangling
+    separators
+    """
+    txt_address = re.sub(r"\s+", " ", txt_address.lower())
+    txt_address = re.sub(r"\s*,\s*", ", ", txt_address)
+    return txt_address.strip(" ,")
+
+
+class GeocodeStore(SQLiteStore):
+    """
+    Geocoded addresses persisted in SQLite, shared by every worker.
+
+    Failed lookups are stored too (negative caching) and only retried once
+    `negative_ttl` seconds have passed. Entries are keyed by normalized
+    address and keep the original one, which is what the provider is asked.
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS geocodes ("
+        "address TEXT PRIMARY KEY, lat REAL, lng REAL, "
+        "ok INTEGER NOT NULL, updated_at REAL NOT NULL, original TEXT)",
+    )
+
+    def __init__(self, path, negative_ttl=60 * 60 * 24 * 7):
+        super().__init__(path)
+        self.negative_ttl = negative_ttl
+
+    def get(self, address):
+        """
+        Return (known, position): position is a (lat, lng) tuple or None if
+        the address could not be geocoded. Expired failures are unknown.
+        """
+        row = (
+            self._connection()
+            .execute(
+                "SELECT lat, lng, ok, updated_at FROM geocodes WHERE address = ?",
+                (normalize_address(address),),
+            )
+            .fetchone()
+        )
+
+        if row is None:
+            return False, None
+
+        lat, lng, ok, updated_at = row
+        if ok:
+            return True, (lat, lng)
+        if updated_at + self.negative_ttl > time.time():
+            return True, None
+        return False, None
+
+    def _migrate(self, connection):
+        if "original" in self._columns(connection, "geocodes"):
+            return
+        try:
+            connection.execute("ALTER TABLE geocodes ADD COLUMN original TEXT")
+        except sqlite3.OperationalError:
+            # Added meanwhile by another worker
+            if "original" not in self._columns(connection, "geocodes"):
+                raise
+
+    def put(self, address, position):
+        lat, lng = position if position else (None, None)
+        connection = self._connection()
+        connection.execute(
+            "INSERT OR REPLACE INTO geocodes "
+            "(address, lat, lng, ok, updated_at, original) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                normalize_address(address),
+                lat,
+                lng,
+                int(bool(position)),
+                time.time(),
+                address,
+            ),
+        )
+        connection.commit()
+
+    def addresses(self, failed_only=False):
+        """
+        Original addresses of the entries, normalized ones for entries
+        stored before originals were kept
+        """
+        query = "SELECT COALESCE(original, address) FROM geocodes"
+        if failed_only:
+            query += " WHERE ok = 0"
+        return [row[0] for row in self._connection().execute(query)]
+
+
+geocode_store = GeocodeStore(
+    app.config.get(
+        "GEOCODE_DB_PATH", os.path.join(app.instance_path, "geocode.sqlite3")
+    ),
+    negative_ttl=app.config.get("GEOCODE_NEGATIVE_TTL", 60 * 60 * 24 * 7),
+)
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket: acquire() blocks until a token is available,
+    so callers never exceed `rate` calls per second (bursts up to
+    `capacity`)
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated_at) * self.rate
+                )
+                self.updated_at = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+
+# Take a token if one is available, otherwise return the seconds to wait.
+# Time comes from the Redis server so every host shares one clock.
+_TAKE_TOKEN = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+local tokens = tonumber(bucket[1]) or capacity
+local updated_at = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated_at) * rate)
+
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated_at', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / rate * 1000) + 1000)
+return tostring(wait)
+"""
+
+
+class RedisTokenBucket:
+    """
+    TokenBucket kept in Redis: every process using it shares the `rate`
+    calls per second. While Redis is unavailable each process falls back to
+    a local bucket of rate / local_share.
+    """
+
+    def __init__(self, get_redis, key, rate, capacity=1, local_share=1):
+        self.get_redis = get_redis
+        self.key = key
+        self.rate = float(rate)
+        self.capacity = capacity
+        self.fallback = TokenBucket(self.rate / local_share, capacity=capacity)
+        self._take_token = None
+
+    def acquire(self):
+        while True:
+            try:
+                client = self.get_redis()
+                if self._take_token is None:
+                    self._take_token = client.register_script(_TAKE_TOKEN)
+                wait = float(
+                    self._take_token(
+                        keys=[self.key], args=[self.rate, self.capacity], client=client
+                    )
+                )
+            except Exception:
+                LOGGER.exception(
+                    "Exception possibly due to Redis, rate limited per process."
+                )
+                return self.fallback.acquire()
+
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+
+# Provider answers worth retrying, anything else is a definitive answer
+TRANSIENT_STATUSES = ("OVER_QUERY_LIMIT", "UNKNOWN_ERROR", "ERROR")
+
+# The provider quota is shared by every worker and the CLI. Without Redis
+# each of the GEOCODE_PROCESSES app processes only takes its share.
+rate_limiter = RedisTokenBucket(
+    get_redis,
+    "geocode:rate",
+    rate=app.config.get("GEOCODE_QPS", 10),
+    capacity=app.config.get("GEOCODE_BURST", 1),
+    local_share=app.config.get("GEOCODE_PROCESSES", 1),
+)
+
+
+def lookup_address(txt_address, retries=None, backoff=None):
+    """
+    Ask the geocoding provider within its rate limit, retrying transient
+    errors with exponential backoff. Returns (position, definitive):
+    position is a (lat, lng) tuple or None, definitive is False when we
+    gave up on transient errors and the result must not be cached.
+    """
+    retries = app.config.get("GEOCODE_RETRIES", 3) if retries is None else retries
+    backoff = app.config.get("GEOCODE_BACKOFF", 0.5) if backoff is None else backoff
+
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(backoff * 2 ** (attempt - 1))
+
+        rate_limiter.acquire()
+        try:
+            geocoding = geocoder.google(
+                txt_address, key=app.config["GOOGLE_API_MAPS_KEY"]
+            )
+        except Exception:
+            LOGGER.exception("Geocoding of <{0}> failed".format(txt_address))
+            continue
+
+        if geocoding.ok:
+            return (geocoding.lat, geocoding.lng), True
+        if not any(status in (geocoding.status or "") for status in TRANSIENT_STATUSES):
+            return None, True
+
+    return None, False
+
+
+def geocode(txt_address):
+    """
+    Position of an address, only asking the provider for unknown ones
+    """
+    known, position = geocode_store.get(txt_address)
+    if known:
+        return position
+
+    position, definitive = lookup_address(txt_address)
+    if definitive:
+        geocode_store.put(txt_address, position)
+
+    return position
+
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """
+    Geocoding thread pool of this worker process, kept apart from the ERP
+    fan-out pool so slow providers never starve ERP calls
+    """
+    global _executor, _executor_pid
+
+    pid = os.getpid()
+    if _executor is None or _executor_pid != pid:
+        with _executor_lock:
+            if _executor is None or _executor_pid != pid:
+                _executor = ThreadPoolExecutor(
+                    max_workers=app.config.get("GEOCODE_WORKERS", 4),
+                    thread_name_prefix="geocode",
+                )
+                _executor_pid = pid
+
+    return _executor
+
+
+def geocode_many(txt_addresses, timeout=None, on_complete=None):
+    """
+    Geocode addresses concurrently. Returns ({address: position}, complete).
+
+    With a timeout, returns as soon as it expires: addresses still being
+    geocoded are missing from the result and keep going in the background,
+    filling the store, then on_complete() is called.
+    """
+    positions = {}
+    unknown = []
+    for txt_address in set(txt_addresses):
+        known, position = geocode_store.get(txt_address)
+        if known:
+            positions[txt_address] = position
+        else:
+            unknown.append(txt_address)
+
+    if not unknown:
+        return positions, True
+
+    executor = get_executor()
+    futures = {
+        executor.submit(geocode, txt_address): txt_address for txt_address in unknown
+    }
+
+    done, pending = wait(futures, timeout=timeout)
+    for future in done:
+        try:
+            positions[futures[future]] = future.result()
+        except Exception:
+            LOGGER.exception("Geocoding of <{0}> failed".format(futures[future]))
+            positions[futures[future]] = None
+
+    if pending:
+        LOGGER.info(
+            "{0} addresses still being geocoded in the background".format(len(pending))
+        )
+        if on_complete is not None:
+            _call_when_done(pending, on_complete)
+
+    return positions, not pending
+
+
+def _call_when_done(futures, callback):
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def done(future):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        try:
+            callback()
+        except Exception:
+            LOGGER.exception("Geocoding completion callback failed")
+
+    for future in futures:
+        future.add_done_callback(done)
+
+
+@app.cli.command("geocode-refresh")
+@click.option("--failed-only", is_flag=True, help="Only retry failed lookups.")
+def geocode_refresh(failed_only):
+    """
+    Geocode again the addresses of the dealer geocode store
+    """
+    addresses = geocode_store.addresses(failed_only=failed_only)
+    for txt_address in addresses:
+        position, definitive = lookup_address(txt_address)
+        if definitive:
+            geocode_store.put(txt_address, position)
+        click.echo("{0}: {1}".format(txt_address, position or "not found"))
+
+    click.echo("{0} addresses refreshed".format(len(addresses)))
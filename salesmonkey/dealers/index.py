@@ -0,0 +1,151 @@
+from datetime import date, timedelta
+import logging
+import os
+
+from erpnext_client.documents import ERPDeliveryNote
+
+from salesmonkey import app
+
+from ..erpnext import list_all
+from .storage import SQLiteStore
+
+LOGGER = logging.getLogger(__name__)
+
+DEALER_GROUPS = "Bar, Cave et Épicerie, Restaurant"
+
+
+class DealerIndex(SQLiteStore):
+    """
+    Dealers (customers of dealer groups delivered within `window_days`)
+    persisted in SQLite, kept up to date from the Delivery Notes modified
+    since the last sync only.
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS dealers ("
+        "customer TEXT PRIMARY KEY, customer_name TEXT, customer_group TEXT, "
+        "shipping_address TEXT, last_delivery TEXT NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS dealer_meta (key TEXT PRIMARY KEY, value TEXT)",
+    )
+
+    def __init__(self, path, window_days=90, page_length=100):
+        super().__init__(path)
+        self.window_days = window_days
+        self.page_length = page_length
+
+    def _get_meta(self, key):
+        row = (
+            self._connection()
+            .execute("SELECT value FROM dealer_meta WHERE key = ?", (key,))
+            .fetchone()
+        )
+        return row[0] if row else None
+
+    def _fetch_delivery_notes(self, cutoff, watermark):
+        """
+        Dealer Delivery Notes modified after the watermark
+        """
+        filters = [
+            ["Delivery Note", "customer_group", "in", DEALER_GROUPS],
+            ["Delivery Note", "posting_date", ">=", cutoff],
+        ]
+        if watermark:
+            filters.append(["Delivery Note", "modified", ">", watermark])
+
+        return list_all(
+            ERPDeliveryNote,
+            erp_fields=[
+                "name",
+                "customer_name",
+                "customer",
+                "customer_group",
+                "shipping_address",
+                "posting_date",
+                "status",
+                "modified",
+            ],
+            filters=filters,
+            page_length=self.page_length,
+        )
+
+    def sync(self):
+        """
+        Process Delivery Notes modified since the last sync and age dealers
+        out of the window, in one transaction. Returns the number of notes
+        processed.
+        """
+        cutoff = (date.today() - timedelta(days=self.window_days)).strftime("%Y-%m-%d")
+        watermark = self._get_meta("watermark")
+
+        # Fetched before writing: no write lock is held during ERP calls
+        notes = self._fetch_delivery_notes(cutoff, watermark)
+
+        new_watermark = watermark
+        for note in notes:
+            new_watermark = max(new_watermark or "", str(note["modified"]))
+
+        connection = self._connection()
+        with connection:
+            for note in notes:
+                if note.get("status") == "Cancelled":
+                    continue
+
+                connection.execute(
+                    "INSERT INTO dealers (customer, customer_name, customer_group, "
+                    "shipping_address, last_delivery) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT(customer) DO UPDATE SET "
+                    "customer_name = excluded.customer_name, "
+                    "customer_group = excluded.customer_group, "
+                    "shipping_address = CASE "
+                    "WHEN excluded.last_delivery >= last_delivery "
+                    "THEN excluded.shipping_address ELSE shipping_address END, "
+                    "last_delivery = MAX(last_delivery, excluded.last_delivery)",
+                    (
+                        note["customer"],
+                        note["customer_name"],
+                        note["customer_group"],
+                        note.get("shipping_address"),
+                        str(note["posting_date"]),
+                    ),
+                )
+
+            if new_watermark != watermark:
+                connection.execute(
+                    "INSERT OR REPLACE INTO dealer_meta (key, value) "
+                    "VALUES ('watermark', ?)",
+                    (new_watermark,),
+                )
+
+            aged_out = connection.execute(
+                "DELETE FROM dealers WHERE last_delivery < ?", (cutoff,)
+            ).rowcount
+
+        LOGGER.debug(
+            "Dealer index synced: {0} delivery notes, {1} dealers aged out".format(
+                len(notes), aged_out
+            )
+        )
+
+        return len(notes)
+
+    def dealers(self):
+        rows = self._connection().execute(
+            "SELECT customer, customer_name, customer_group, shipping_address "
+            "FROM dealers ORDER BY customer"
+        )
+        return [
+            {
+                "customer": customer,
+                "customer_name": customer_name,
+                "customer_group": customer_group,
+                "shipping_address": shipping_address,
+            }
+            for customer, customer_name, customer_group, shipping_address in rows
+        ]
+
+
+dealer_index = DealerIndex(
+    app.config.get(
+        "DEALER_INDEX_DB_PATH", os.path.join(app.instance_path, "dealers.sqlite3")
+    )
+)
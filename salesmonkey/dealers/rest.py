@@ -1,17 +1,16 @@
-from datetime import date, datetime, timedelta
+import copy
 import logging
+import uuid
 
-import geocoder
+from werkzeug.exceptions import BadRequest, NotFound
 
-from werkzeug.exceptions import NotFound
+from marshmallow import validate
 
 from flask_apispec import marshal_with, MethodResource, use_kwargs
 
 from erpnext_client.documents import (
     ERPContact,
     ERPAddress,
-    ERPCustomer,
-    ERPDeliveryNote,
 )
 
 from erpnext_client.schemas import (
@@ -27,10 +26,16 @@ from salesmonkey import cache
 from salesmonkey import app
 
 from ..rest import api_v1
-from ..erpnext import erp_client
+from ..erpnext import get_customers
+from .geocoding import geocode_many
+from .index import dealer_index
+from .spatial import DealerSpatialIndex
 
 LOGGER = logging.getLogger(__name__)
 
+# Id of the latest dealer list build, see DealerSpatialIndex
+DEALER_LIST_VERSION_KEY = "dealers:version"
+
 
 class DealerReferenceSchema(Schema):
     name = fields.Str()
@@ -46,79 +51,155 @@ class DealerSchema(Schema):
     references = fields.Nested(DealerReferenceSchema)
 
 
+class NearbyDealerSchema(DealerSchema):
+    distance_km = fields.Float()
+
+
+@cache.memoize(timeout=60 * 60 * 12, stale_ttl=60 * 60 * 24, lock=True, xfetch_beta=1.0)
+def build_dealer_list():
+    """
+    Return (build_id, dealers): build_id is stored with the list it labels,
+    see DealerSpatialIndex
+    """
+    # Only Delivery Notes modified since the last build are fetched
+    dealer_index.sync()
+
+    entries = dealer_index.dealers()
+    customers = get_customers(entry["customer"] for entry in entries)
+
+    dealer_list = {}
+    for entry in entries:
+        customer = customers.get(entry["customer"])
+        if customer is None:
+            LOGGER.warning(
+                "Dealer customer <{0}> not found in ERP".format(entry["customer"])
+            )
+            continue
+
+        dealer = DealerSchema()
+        dealer.name = customer["name"]
+        dealer.spot_type = entry["customer_group"]
+
+        if entry["shipping_address"]:
+            dealer.address = (
+                entry["shipping_address"]
+                .replace("<br>", ", ")
+                .replace("\n", "")
+                .rstrip(", ")
+            )
+
+        dealer_list[dealer.name] = dealer
+
+    if not dealer_list:
+        raise NotFound
+
+    # Forward geocode addresses, without waiting on slow ones: they are
+    # added to the next build once geocoded
+    positions, complete = geocode_many(
+        [d.address for d in dealer_list.values() if getattr(d, "address", None)],
+        timeout=app.config.get("GEOCODE_DEADLINE", 5),
+        on_complete=lambda: cache.delete_memoized(build_dealer_list),
+    )
+
+    for dealer in dealer_list.values():
+        position = positions.get(getattr(dealer, "address", None))
+        if position:
+            dealer.position_lat, dealer.position_lng = position
+
+    # Announced before the memo entry is written: readers of the version
+    # may still load the previous list for a moment
+    build_id = uuid.uuid4().hex
+    cache.set(DEALER_LIST_VERSION_KEY, build_id, timeout=0)
+
+    return build_id, [d for d in dealer_list.values()]
+
+
 @marshal_with(DealerSchema(many=True))
 class DealerList(MethodResource):
     """
     List dealers
     """
 
-    @cache.memoize(timeout=30)
-    def _get_customer(self, name):
-        return erp_client.query(ERPCustomer).get(name=name)
-
-    @cache.memoize(timeout=60 * 60 * 12)
     def get(self):
-        three_months_ago = date.today() - timedelta(days=90)
-        dealer_list = {}
-        try:
-            delivery_list = erp_client.query(ERPDeliveryNote).list(
-                erp_fields=[
-                    "customer_name",
-                    "customer",
-                    "customer_group",
-                    "shipping_address",
-                ],
-                filters=[
-                    [
-                        "Delivery Note",
-                        "customer_group",
-                        "in",
-                        "Bar, Cave et Épicerie, Restaurant",
-                    ],
-                    [
-                        "Delivery Note",
-                        "posting_date",
-                        ">=",
-                        three_months_ago.strftime("%Y-%m-%d"),
-                    ],
-                    ["Delivery Note", "status", "!=", "Cancelled"],
-                ],
-                page_length=100,
+        return build_dealer_list()[1]
+
+
+api_v1.register("/dealers/", DealerList, session=False)
+
+
+def _load_dealers():
+    try:
+        return build_dealer_list()
+    except NotFound:
+        return None, []
+
+
+def _dealer_list_version():
+    try:
+        return cache.get(DEALER_LIST_VERSION_KEY)
+    except Exception:
+        LOGGER.exception("Exception possibly due to cache backend.")
+        return None
+
+
+dealer_spatial_index = DealerSpatialIndex(_load_dealers, _dealer_list_version)
+
+
+@marshal_with(NearbyDealerSchema(many=True))
+class NearbyDealerList(MethodResource):
+    """
+    List dealers within a radius of a position, nearest first
+    """
+
+    @use_kwargs(
+        {
+            "lat": fields.Float(required=True, validate=validate.Range(-90, 90)),
+            "lng": fields.Float(required=True, validate=validate.Range(-180, 180)),
+            "km": fields.Float(missing=10, validate=validate.Range(0, 500)),
+            "limit": fields.Int(missing=50, validate=validate.Range(1, 500)),
+        }
+    )
+    def get(self, lat, lng, km, limit):
+        dealers = []
+        for distance, dealer in dealer_spatial_index.get().nearby(
+            lat, lng, km, limit=limit
+        ):
+            # Indexed dealers are shared between requests
+            dealer = copy.copy(dealer)
+            dealer.distance_km = round(distance, 3)
+            dealers.append(dealer)
+
+        return dealers
+
+
+@marshal_with(DealerSchema(many=True))
+class ViewportDealerList(MethodResource):
+    """
+    List dealers inside a map viewport
+    """
+
+    @use_kwargs(
+        {
+            "south": fields.Float(required=True, validate=validate.Range(-90, 90)),
+            "west": fields.Float(required=True, validate=validate.Range(-180, 180)),
+            "north": fields.Float(required=True, validate=validate.Range(-90, 90)),
+            "east": fields.Float(required=True, validate=validate.Range(-180, 180)),
+        }
+    )
+    def get(self, south, west, north, east):
+        if south > north:
+            raise BadRequest("south must not be greater than north")
+
+        index = dealer_spatial_index.get()
+
+        # Viewport crossing the antimeridian
+        if west > east:
+            return index.within_bbox(south, west, north, 180) + index.within_bbox(
+                south, -180, north, east
             )
-        except ERPDeliveryNote.DoesNotExist:
-            raise NotFound
-
-        for delivery in delivery_list:
-            if delivery["customer_name"] not in dealer_list:
-                customer = self._get_customer(name=delivery["customer"])
-                dealer = DealerSchema()
-                dealer.name = customer["name"]
-                dealer.spot_type = delivery["customer_group"]
-
-                if "shipping_address" in delivery:
-                    txt_address = (
-                        delivery["shipping_address"]
-                        .replace("<br>", ", ")
-                        .replace("\n", "")
-                        .rstrip(", ")
-                    )
-
-                    # Forward geocode address
-                    try:
-                        geocoding = geocoder.google(
-                            txt_address, key=app.config["GOOGLE_API_MAPS_KEY"]
-                        )
-                        if geocoding.ok:
-                            dealer.position_lat = geocoding.lat
-                            dealer.position_lng = geocoding.lng
-                    except Exception:
-                        pass
-
-                    dealer.address = txt_address
-
-                dealer_list[dealer.name] = dealer
-
-        return [d for d in dealer_list.values()]
-
-
-api_v1.register("/dealers/", DealerList)
+
+        return index.within_bbox(south, west, north, east)
+
+
+api_v1.register("/dealers/nearby", NearbyDealerList, session=False)
+api_v1.register("/dealers/bbox", ViewportDealerList, session=False)
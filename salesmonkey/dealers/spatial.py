@@ -0,0 +1,167 @@
+import math
+import threading
+import time
+from collections import defaultdict
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    """
+    Great-circle distance between two positions, in kilometers
+    """
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lng2 - lng1)
+    a = (
+        math.sin(dphi / 2) ** 2
+        + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+class GridIndex:
+    """
+    Points bucketed in a regular lat/lng grid of `cell_size` degrees, so
+    radius and viewport queries only look at the cells they overlap.
+    """
+
+    def __init__(self, points, cell_size=0.1):
+        """
+        points is an iterable of (lat, lng, item)
+        """
+        self.cell_size = cell_size
+        self.cells = defaultdict(list)
+        self.size = 0
+
+        for lat, lng, item in points:
+            self.cells[self._cell(lat, lng)].append((lat, lng, item))
+            self.size += 1
+
+    def _cell(self, lat, lng):
+        return (
+            int(math.floor(lat / self.cell_size)),
+            int(math.floor(lng / self.cell_size)),
+        )
+
+    def _candidates(self, south, west, north, east):
+        (min_row, min_col), (max_row, max_col) = (
+            self._cell(south, west),
+            self._cell(north, east),
+        )
+
+        # Large areas: walking the occupied cells is cheaper than the grid
+        if (max_row - min_row + 1) * (max_col - min_col + 1) > len(self.cells):
+            for (row, col), points in self.cells.items():
+                if min_row <= row <= max_row and min_col <= col <= max_col:
+                    yield from points
+            return
+
+        for row in range(min_row, max_row + 1):
+            for col in range(min_col, max_col + 1):
+                yield from self.cells.get((row, col), ())
+
+    def within_bbox(self, south, west, north, east):
+        """
+        Items inside the viewport
+        """
+        return [
+            item
+            for lat, lng, item in self._candidates(south, west, north, east)
+            if south <= lat <= north and west <= lng <= east
+        ]
+
+    def nearby(self, lat, lng, radius_km, limit=None):
+        """
+        (distance_km, item) pairs within radius_km of a position, nearest
+        first
+        """
+        dlat = radius_km / KM_PER_DEGREE
+        dlng = radius_km / (KM_PER_DEGREE * max(math.cos(math.radians(lat)), 1e-6))
+
+        matches = []
+        for p_lat, p_lng, item in self._candidates(
+            lat - dlat, lng - dlng, lat + dlat, lng + dlng
+        ):
+            distance = haversine_km(lat, lng, p_lat, p_lng)
+            if distance <= radius_km:
+                matches.append((distance, item))
+
+        matches.sort(key=lambda match: match[0])
+        return matches[:limit] if limit else matches
+
+
+class DealerSpatialIndex:
+    """
+    Grid index over the positioned dealers of the dealer list cache.
+
+    load_dealers() returns (build_id, dealers) as stored in the cache and
+    get_version() the id of the latest build. The index is labelled with
+    the build id it was loaded with, so it is rebuilt only when another
+    build happened, or after max_age seconds: requests otherwise only read
+    the version. A build announces its id just before storing its list:
+    while they differ the list is reloaded at most every retry_interval
+    seconds.
+    """
+
+    def __init__(
+        self,
+        load_dealers,
+        get_version,
+        cell_size=0.1,
+        max_age=60 * 60,
+        retry_interval=10,
+    ):
+        self.load_dealers = load_dealers
+        self.get_version = get_version
+        self.cell_size = cell_size
+        self.max_age = max_age
+        self.retry_interval = retry_interval
+        self._lock = threading.Lock()
+        self._version = None
+        self._built_at = None
+        self._loaded_at = None
+        self._index = None
+
+    @staticmethod
+    def _positioned(dealers):
+        return [
+            (dealer.position_lat, dealer.position_lng, dealer)
+            for dealer in dealers
+            if getattr(dealer, "position_lat", None) is not None
+            and getattr(dealer, "position_lng", None) is not None
+        ]
+
+    def _is_fresh(self, version):
+        if self._index is None:
+            return False
+
+        now = time.monotonic()
+        if now - self._built_at >= self.max_age:
+            return False
+
+        return version == self._version or now - self._loaded_at < self.retry_interval
+
+    def get(self):
+        version = self.get_version()
+        if self._is_fresh(version):
+            return self._index
+
+        with self._lock:
+            if self._is_fresh(version):
+                return self._index
+
+            build_id, dealers = self.load_dealers()
+            now = time.monotonic()
+            if (
+                build_id != self._version
+                or self._index is None
+                or now - self._built_at >= self.max_age
+            ):
+                points = self._positioned(dealers)
+                self._index = GridIndex(points, cell_size=self.cell_size)
+                self._version = build_id
+                self._built_at = now
+            self._loaded_at = now
+            return self._index
@@ -0,0 +1,41 @@
+import os
+import sqlite3
+import threading
+
+
+class SQLiteStore:
+    """
+    SQLite database shared by every worker, with one connection per thread.
+    Subclasses list the statements creating their tables in SCHEMA, and
+    upgrade tables created by former versions in _migrate().
+    """
+
+    SCHEMA = ()
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=10)
+            connection.execute("PRAGMA journal_mode=WAL")
+            for statement in self.SCHEMA:
+                connection.execute(statement)
+            self._migrate(connection)
+            connection.commit()
+            self._local.connection = connection
+        return connection
+
+    def _migrate(self, connection):
+        pass
+
+    @staticmethod
+    def _columns(connection, table):
+        return {
+            row[1] for row in connection.execute("PRAGMA table_info({0})".format(table))
+        }
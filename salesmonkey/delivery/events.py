@@ -0,0 +1,167 @@
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+
+LOGGER = logging.getLogger(__name__)
+
+
+def format_event(event, data):
+    """
+    Server-Sent Events message
+    """
+    return "event: {0}\ndata: {1}\n\n".format(event, json.dumps(data))
+
+
+class EventBroker:
+    """
+    Fan out the messages of a Redis pub/sub channel to the event streams of
+    this process: whatever the number of connected clients, a process holds
+    a single Redis subscription.
+    """
+
+    def __init__(self, get_redis, channel, heartbeat=15, max_pending=100):
+        self.get_redis = get_redis
+        self.channel = channel
+        self.heartbeat = heartbeat
+        self.max_pending = max_pending
+
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._listener_pid = None
+
+    def publish(self, event, data):
+        self.get_redis().publish(
+            self.channel, json.dumps({"event": event, "data": data})
+        )
+
+    def subscriber_count(self):
+        return len(self._subscribers)
+
+    def _ensure_listener(self):
+        pid = os.getpid()
+        with self._lock:
+            if self._listener_pid == pid:
+                return
+            self._listener_pid = pid
+
+        threading.Thread(target=self._listen, name="event-broker", daemon=True).start()
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.get_redis().pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                for message in pubsub.listen():
+                    if message["type"] == "message":
+                        self._dispatch(json.loads(message["data"]))
+            except Exception:
+                LOGGER.exception("Event subscription lost, reconnecting")
+                time.sleep(1)
+
+    def _dispatch(self, message):
+        with self._lock:
+            subscribers = list(self._subscribers)
+
+        for pending in subscribers:
+            try:
+                pending.put_nowait(message)
+            except queue.Full:
+                # Slow client: drop its oldest message rather than block
+                try:
+                    pending.get_nowait()
+                except queue.Empty:
+                    pass
+                pending.put_nowait(message)
+
+    def stream(self, initial=(), accept=None):
+        """
+        Subscribe a client and return its event stream: `initial` (event,
+        data) pairs first, then every published event accept(event, data)
+        is true for, with heartbeat comments in between to keep the
+        connection open
+        """
+        pending = queue.Queue(maxsize=self.max_pending)
+        with self._lock:
+            self._subscribers.add(pending)
+        self._ensure_listener()
+
+        def generate():
+            try:
+                for event, data in initial:
+                    yield format_event(event, data)
+
+                while True:
+                    try:
+                        message = pending.get(timeout=self.heartbeat)
+                    except queue.Empty:
+                        yield ": keepalive\n\n"
+                        continue
+
+                    if accept is None or accept(message["event"], message["data"]):
+                        yield format_event(message["event"], message["data"])
+            finally:
+                with self._lock:
+                    self._subscribers.discard(pending)
+
+        return generate()
+
+
+class SharedPoller:
+    """
+    Run poll() every `interval` seconds in a single process among all those
+    sharing the Redis server, and only while is_needed() is true in one of
+    them. The process holding the Redis lock polls, the others stand by to
+    take over if it stops renewing it.
+    """
+
+    def __init__(self, get_redis, lock_key, poll, is_needed, interval=10):
+        self.get_redis = get_redis
+        self.lock_key = lock_key
+        self.poll = poll
+        self.is_needed = is_needed
+        self.interval = interval
+
+        self._token = None
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def ensure_running(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(
+                target=self._run, name="shared-poller", daemon=True
+            )
+            self._thread.start()
+
+    def _is_leader(self, client):
+        lock_ttl = int(self.interval * 3 * 1000)
+        if client.set(self.lock_key, self._token, nx=True, px=lock_ttl):
+            return True
+        if client.get(self.lock_key) == self._token.encode("utf-8"):
+            client.pexpire(self.lock_key, lock_ttl)
+            return True
+        return False
+
+    def _run(self):
+        # One token per thread: a forked process must not share its parent's
+        self._token = uuid.uuid4().hex
+        client = self.get_redis()
+        try:
+            while self.is_needed():
+                try:
+                    if self._is_leader(client):
+                        self.poll()
+                except Exception:
+                    LOGGER.exception("Shared poll failed")
+                time.sleep(self.interval)
+        finally:
+            try:
+                if client.get(self.lock_key) == self._token.encode("utf-8"):
+                    client.delete(self.lock_key)
+            except Exception:
+                LOGGER.exception("Could not release poller lock")
@@ -1,5 +1,8 @@
+import functools
+import json
 import logging
 
+from flask import Response, stream_with_context
 from werkzeug.exceptions import NotFound
 
 from flask_apispec import marshal_with, MethodResource, use_kwargs
@@ -15,10 +18,17 @@ from erpnext_client.schemas import (
 
 from webargs import fields
 
-from salesmonkey import cache
+from salesmonkey import app, cache
 
 from ..rest import api_v1
-from ..erpnext import erp_client
+from ..erpnext import erp_client, get_documents
+from ..utils import doc_tag
+from ..fanout import fan_out, submit_background
+from ..store import get_redis
+from ..webhooks.rest import on_document_change
+from ..dealers.geocoding import geocode_many
+from .events import EventBroker, SharedPoller
+from .routing import optimize_route
 
 LOGGER = logging.getLogger(__name__)
 
@@ -26,12 +36,14 @@ LOGGER = logging.getLogger(__name__)
 class DeliveryStopWithContactSchema(ERPDeliveryStopSchema):
     contact = fields.Nested("ERPContactSchema")
     address = fields.Nested("ERPAddressSchema")
+    distance_km = fields.Float()
 
 
 class DeliveryTripWithContactSchema(ERPDeliveryTripSchema):
     stops = fields.Nested(
         "DeliveryStopWithContactSchema", load_from="delivery_stops", many=True
     )
+    estimated_distance_km = fields.Float()
 
 
 @marshal_with(ERPDeliveryTripSchema(many=True))
@@ -40,7 +52,7 @@ class DeliveryTripList(MethodResource):
     List available Delivery Trip List
     """
 
-    @cache.memoize(timeout=10)
+    @cache.memoize(timeout=60 * 60, tags=[doc_tag("Delivery Trip")])
     def get(self):
         try:
             trip_list = erp_client.query(ERPDeliveryTrip).list(
@@ -52,34 +64,290 @@ class DeliveryTripList(MethodResource):
         return trip_list
 
 
+def _trip_tags(trip, self, name):
+    """
+    ERP documents a trip entry depends on: the trip, and the contact and
+    address embedded in each stop
+    """
+    tags = {doc_tag("Delivery Trip", name)}
+    for stop in trip["stops"]:
+        if stop.get("contact"):
+            tags.add(doc_tag("Contact", stop["contact"]["name"]))
+        if stop.get("address"):
+            tags.add(doc_tag("Address", stop["address"]["name"]))
+
+    return sorted(tags)
+
+
 class DeliveryTripDetails(MethodResource):
     """
     Help Delivery by giving customer infos and gmap trip
     """
 
-    @cache.memoize(timeout=3600)
+    @cache.memoize(
+        timeout=3600, tags=lambda contact, self, name: [doc_tag("Contact", name)]
+    )
     def _get_contact_info(self, contact_name):
         return erp_client.query(ERPContact).get(contact_name)
 
-    @cache.memoize(timeout=3600)
+    @cache.memoize(
+        timeout=3600, tags=lambda address, self, name: [doc_tag("Address", name)]
+    )
     def _get_address_info(self, address_name):
         return erp_client.query(ERPAddress).get(address_name)
 
-    @marshal_with(DeliveryTripWithContactSchema)
-    @cache.memoize(timeout=10)
-    def get(self, name):
+    # Stops embed list query documents, which lack the child tables of the
+    # full ones above: they are memoized under their own keys
+    @cache.memoize(
+        timeout=3600, tags=lambda contact, self, name: [doc_tag("Contact", name)]
+    )
+    def _get_stop_contact(self, contact_name):
+        return get_documents(ERPContact, "Contact", [contact_name]).get(contact_name)
+
+    @cache.memoize(
+        timeout=3600, tags=lambda address, self, name: [doc_tag("Address", name)]
+    )
+    def _get_stop_address(self, address_name):
+        return get_documents(ERPAddress, "Address", [address_name]).get(address_name)
+
+    def _get_many(self, memoized, doc_class, doctype, names):
+        """
+        Documents of many stops: one batched query for those missing from
+        the per-name memo cache of `memoized`, which is warmed with the
+        result
+        """
+        results = cache.memoized_many(
+            memoized,
+            [(self, name) for name in names],
+            lambda missing: {
+                (self, name): document
+                for name, document in get_documents(
+                    doc_class, doctype, [name for _, name in missing]
+                ).items()
+            },
+        )
+        return {name: document for (_, name), document in results.items()}
+
+    @cache.memoize(timeout=60 * 60, tags=_trip_tags)
+    def _get_trip(self, name):
         try:
             trip = erp_client.query(ERPDeliveryTrip).get(name)
         except ERPDeliveryTrip.DoesNotExist:
             raise NotFound
 
-        for stop in trip["stops"]:
-            full_contact = self._get_contact_info(stop["contact"])
-            stop["address"] = self._get_address_info(stop["address"])
-            stop["contact"] = full_contact
+        # One batched query per doctype, both at once
+        stops = trip["stops"]
+        infos = fan_out(
+            {
+                "contacts": functools.partial(
+                    self._get_many,
+                    DeliveryTripDetails._get_stop_contact,
+                    ERPContact,
+                    "Contact",
+                    [stop["contact"] for stop in stops if stop.get("contact")],
+                ),
+                "addresses": functools.partial(
+                    self._get_many,
+                    DeliveryTripDetails._get_stop_address,
+                    ERPAddress,
+                    "Address",
+                    [stop["address"] for stop in stops if stop.get("address")],
+                ),
+            }
+        )
+        contacts, addresses = infos["contacts"], infos["addresses"]
+
+        for stop in stops:
+            stop["address"] = addresses.get(stop.get("address"))
+            stop["contact"] = contacts.get(stop.get("contact"))
 
         return trip
 
+    def _optimize_stops(self, trip):
+        """
+        Reorder stops into a short route from the depot, setting the distance
+        travelled to reach each of them. Stops without a known position are
+        left at the end, in their ERP order.
+        """
+        stops = trip["stops"]
+
+        addresses = {}
+        for stop in stops:
+            if not (stop.get("lat") and stop.get("lng")) and stop["address"]:
+                addresses[id(stop)] = format_address(stop["address"])
+
+        # Slow addresses are left unlocated, they are ready on next call
+        positions, _ = geocode_many(
+            addresses.values(), timeout=app.config.get("GEOCODE_DEADLINE", 5)
+        )
+
+        located, unlocated = [], []
+        for stop in stops:
+            if stop.get("lat") and stop.get("lng"):
+                located.append(((stop["lat"], stop["lng"]), stop))
+            elif positions.get(addresses.get(id(stop))):
+                located.append((positions[addresses[id(stop)]], stop))
+            else:
+                unlocated.append(stop)
+
+        order, legs = optimize_route(
+            [position for position, stop in located],
+            start=app.config.get("DELIVERY_DEPOT"),
+        )
+
+        trip["stops"] = []
+        for idx, distance in zip(order, legs):
+            stop = located[idx][1]
+            stop["distance_km"] = round(distance, 3)
+            trip["stops"].append(stop)
+        trip["stops"].extend(unlocated)
+        trip["estimated_distance_km"] = round(sum(legs), 3)
+
+        if unlocated:
+            LOGGER.info(
+                "{0} stops of trip <{1}> could not be located".format(
+                    len(unlocated), trip["name"]
+                )
+            )
+
+    @marshal_with(DeliveryTripWithContactSchema)
+    @use_kwargs({"optimize": fields.Bool(missing=False)})
+    def get(self, name, optimize):
+        trip = self._get_trip(name)
+
+        if optimize:
+            self._optimize_stops(trip)
+
+        return trip
+
+
+def format_address(address):
+    """
+    One line postal address of an ERP Address, for geocoding
+    """
+    parts = [
+        address.get("address_line1"),
+        address.get("address_line2"),
+        " ".join(filter(None, (address.get("pincode"), address.get("city")))),
+        address.get("country"),
+    ]
+    return ", ".join(part for part in parts if part)
+
+
+broker = EventBroker(
+    get_redis,
+    "delivery:events",
+    heartbeat=app.config.get("DELIVERY_EVENTS_HEARTBEAT", 15),
+)
+
+TRIP_SNAPSHOT_KEY = "delivery:trips:modified"
+
+
+def _trip_list_payload():
+    try:
+        trip_list = DeliveryTripList().get()
+    except NotFound:
+        trip_list = []
+    return ERPDeliveryTripSchema(many=True).dump(trip_list).data
+
+
+def _trip_payload(name):
+    try:
+        trip = DeliveryTripDetails()._get_trip(name)
+    except NotFound:
+        return {"name": name, "deleted": True}
+    return DeliveryTripWithContactSchema().dump(trip).data
+
+
+def publish_trip_changes(names, list_changed=True):
+    """
+    Purge the cached trips and push their fresh version to every connected
+    driver
+    """
+    for name in names:
+        cache.delete_tagged(doc_tag("Delivery Trip", name))
+        broker.publish("trip", _trip_payload(name))
+
+    if list_changed:
+        cache.delete_tagged(doc_tag("Delivery Trip"))
+        broker.publish("trip_list", _trip_list_payload())
+
+
+def poll_trips():
+    """
+    Compare the modification dates of scheduled trips with those of the
+    previous poll and publish the trips that changed
+    """
+    try:
+        trips = erp_client.query(ERPDeliveryTrip).list(
+            erp_fields=["name", "modified"],
+            filters=[["Delivery Trip", "status", "=", "Scheduled"]],
+        )
+    except ERPDeliveryTrip.DoesNotExist:
+        trips = []
+
+    modified = {trip["name"]: str(trip["modified"]) for trip in trips}
+
+    client = get_redis()
+    snapshot = client.get(TRIP_SNAPSHOT_KEY)
+    client.set(TRIP_SNAPSHOT_KEY, json.dumps(modified))
+    if snapshot is None:
+        return
+
+    previous = json.loads(snapshot)
+    changed = [
+        name
+        for name in set(modified) | set(previous)
+        if modified.get(name) != previous.get(name)
+    ]
+    if changed:
+        publish_trip_changes(changed)
+
+
+def _poll_trips_in_context():
+    with app.app_context():
+        poll_trips()
+
+
+trip_poller = SharedPoller(
+    get_redis,
+    "delivery:trips:poller",
+    _poll_trips_in_context,
+    is_needed=lambda: broker.subscriber_count() > 0,
+    interval=app.config.get("DELIVERY_POLL_INTERVAL", 10),
+)
+
+
+@on_document_change("Delivery Trip")
+def _trip_changed(document):
+    submit_background(functools.partial(publish_trip_changes, [document["name"]]))
+
+
+class DeliveryTripEvents(MethodResource):
+    """
+    Stream trip list and trip changes to drivers as Server-Sent Events
+    instead of having them poll
+    """
+
+    @use_kwargs({"trip": fields.Str(missing=None)})
+    def get(self, trip):
+        initial = [("trip_list", _trip_list_payload())]
+        if trip:
+            initial.append(("trip", _trip_payload(trip)))
+
+        def accept(event, data):
+            return event == "trip_list" or not trip or data["name"] == trip
+
+        stream = broker.stream(initial=initial, accept=accept)
+        trip_poller.ensure_running()
+
+        return Response(
+            stream_with_context(stream),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
 
+api_v1.register("/delivery/trip/events", DeliveryTripEvents)
 api_v1.register("/delivery/trip/<name>", DeliveryTripDetails)
 api_v1.register("/delivery/trip/", DeliveryTripList)
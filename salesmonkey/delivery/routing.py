@@ -0,0 +1,96 @@
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def distance_matrix(positions):
+    """
+    Great-circle distances in kilometers between every pair of (lat, lng)
+    positions, as a square array
+    """
+    coords = np.radians(np.asarray(positions, dtype=float).reshape(-1, 2))
+    lat, lng = coords[:, 0], coords[:, 1]
+
+    dlat = lat[:, None] - lat[None, :]
+    dlng = lng[:, None] - lng[None, :]
+    a = (
+        np.sin(dlat / 2) ** 2
+        + np.cos(lat)[:, None] * np.cos(lat)[None, :] * np.sin(dlng / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def nearest_neighbour(matrix, start=0):
+    """
+    Path visiting every node, always going to the closest unvisited one
+    """
+    size = len(matrix)
+    visited = np.zeros(size, dtype=bool)
+    route = [start]
+    visited[start] = True
+
+    for _ in range(size - 1):
+        distances = np.where(visited, np.inf, matrix[route[-1]])
+        node = int(np.argmin(distances))
+        route.append(node)
+        visited[node] = True
+
+    return route
+
+
+def two_opt(route, matrix, max_passes=50):
+    """
+    Improve a path by reversing the segments that shorten it, until none
+    does. The first and last nodes stay in place.
+    """
+    route = np.array(route)
+    size = len(route)
+
+    for _ in range(max_passes):
+        improved = False
+        for i in range(1, size - 2):
+            a, b = route[i - 1], route[i]
+            c, e = route[i + 1 : size - 1], route[i + 2 :]
+            # Gain of reversing route[i:j + 1] for every j at once
+            gains = matrix[a, b] + matrix[c, e] - matrix[a, c] - matrix[b, e]
+            best = int(np.argmax(gains))
+            if gains[best] > 1e-9:
+                j = i + 1 + best
+                route[i : j + 1] = route[i : j + 1][::-1]
+                improved = True
+        if not improved:
+            break
+
+    return route.tolist()
+
+
+def optimize_route(positions, start=None):
+    """
+    Order positions into a short open path: nearest neighbour construction
+    improved with 2-opt. The path starts at `start`, a (lat, lng) position
+    which is not part of the result, or at the first position.
+
+    Returns (order, legs): indexes of positions in visiting order, and the
+    distance in kilometers travelled to reach each of them.
+    """
+    if not positions:
+        return [], []
+
+    points = list(positions)
+    if start is not None:
+        points.insert(0, start)
+
+    # An extra node at distance 0 from every other one ends the path
+    # anywhere: 2-opt then optimizes an open path while keeping ends fixed
+    size = len(points)
+    matrix = np.zeros((size + 1, size + 1))
+    matrix[:size, :size] = distance_matrix(points)
+
+    route = nearest_neighbour(matrix[:size, :size])
+    route = two_opt(route + [size], matrix)[:-1]
+
+    legs = [0.0] + [float(matrix[a, b]) for a, b in zip(route, route[1:])]
+
+    if start is not None:
+        return [node - 1 for node in route[1:]], legs[1:]
+    return route, legs
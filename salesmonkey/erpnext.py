@@ -1,17 +1,85 @@
+from datetime import date
 import logging
 
 from salesmonkey import app
 
+from erpnext_client.documents import ERPBin, ERPCustomer, ERPDocument, ERPItemPrice
 from erpnext_client.query import ERPNextClient
 
+from .singleflight import SingleFlight
+from .store import get_redis
+from .transport import install_pooled_transport
+
 LOGGER = logging.getLogger(__name__)
 
 
+class ERPShippingRule(ERPDocument):
+    doctype = "Shipping Rule"
+
+
+class ERPSalesTaxesAndChargesTemplate(ERPDocument):
+    doctype = "Sales Taxes and Charges Template"
+
+
+class CoalescedQuery:
+    """
+    Proxy of an ERPNextClient query whose reads go through a SingleFlight:
+    identical concurrent (doctype, name, fields, filters) reads share a
+    single ERP call.
+    """
+
+    READ_METHODS = ("get", "first", "list")
+
+    def __init__(self, query, doctype, single_flight):
+        self._query = query
+        self._doctype = doctype
+        self._single_flight = single_flight
+
+    def __getattr__(self, attr):
+        method = getattr(self._query, attr)
+        if attr not in self.READ_METHODS:
+            return method
+
+        def coalesced(*args, **kwargs):
+            key = "{0}.{1}:{2!r}:{3!r}".format(
+                self._doctype.__name__, attr, args, sorted(kwargs.items())
+            )
+            return self._single_flight.do(key, lambda: method(*args, **kwargs))
+
+        return coalesced
+
+
+def install_single_flight(client, config):
+    """
+    Route the client reads through a process and Redis wide SingleFlight
+    """
+    single_flight = SingleFlight(
+        get_redis=get_redis if config.get("ERP_SINGLEFLIGHT_REDIS", True) else None,
+        lock_timeout=config.get("ERP_SINGLEFLIGHT_LOCK_TIMEOUT", 10),
+    )
+    query = client.query
+
+    def coalesced_query(doctype):
+        return CoalescedQuery(query(doctype), doctype, single_flight)
+
+    client.query = coalesced_query
+
+    return single_flight
+
+
 erp_client = ERPNextClient(
     app.config["ERPNEXT_API_HOST"],
     app.config["ERPNEXT_API_KEY"],
     app.config["ERPNEXT_API_SECRET"],
 )
+
+# All ERP calls from the app share this keep-alive connection pool
+erp_transport = install_pooled_transport(erp_client, app.config)
+
+# Identical concurrent reads (cache expiry spikes) share one ERP call
+if app.config.get("ERP_SINGLEFLIGHT", True):
+    install_single_flight(erp_client, app.config)
+
 if not erp_client.login():
     LOGGER.error(
         "Login failed on ERP at {0} using API KEY {1}".format(
@@ -24,3 +92,137 @@ else:
             erp_client.host, erp_client.api_key
         )
     )
+
+
+def get_projected_qtys(item_warehouses):
+    """
+    Return the projected quantity of many (item_code, warehouse) pairs using
+    one Bin query. Pairs without any Bin had no stock movement: they map to 0.
+    """
+    pairs = set(item_warehouses)
+    qtys = dict.fromkeys(pairs, 0)
+    if not pairs:
+        return qtys
+
+    item_codes = sorted({item_code for item_code, warehouse in pairs})
+    warehouses = sorted({warehouse for item_code, warehouse in pairs})
+
+    try:
+        bins = erp_client.query(ERPBin).list(
+            erp_fields=["item_code", "warehouse", "projected_qty"],
+            filters=[
+                ["Bin", "item_code", "in", item_codes],
+                ["Bin", "warehouse", "in", warehouses],
+            ],
+            page_length=len(item_codes) * len(warehouses),
+        )
+    except ERPBin.DoesNotExist:
+        return qtys
+
+    for bin in bins:
+        key = (bin["item_code"], bin["warehouse"])
+        if key in qtys:
+            qtys[key] = bin["projected_qty"]
+
+    return qtys
+
+
+def list_all(doc_class, erp_fields, filters, page_length=100):
+    """
+    Every document of a list query, fetched `page_length` at a time using
+    limit_start. A document moved to another page by a concurrent change
+    is returned once.
+    """
+    documents = {}
+    start = 0
+    while True:
+        try:
+            page = erp_client.query(doc_class).list(
+                erp_fields=erp_fields,
+                filters=filters,
+                page_length=page_length,
+                limit_start=start,
+            )
+        except doc_class.DoesNotExist:
+            break
+
+        for document in page:
+            documents.setdefault(document["name"], document)
+
+        if len(page) < page_length:
+            break
+        start += page_length
+
+    return list(documents.values())
+
+
+def get_item_prices(item_codes, price_list, page_length=100):
+    """
+    Return the selling rate of many items on a price list using as few Item
+    Price queries as possible. Items may have many prices (validity
+    periods): the one valid today with the latest valid_from wins. Items
+    without a price are left out of the result.
+    """
+    item_codes = sorted(set(item_codes))
+    if not item_codes:
+        return {}
+
+    rows = list_all(
+        ERPItemPrice,
+        erp_fields=["name", "item_code", "price_list_rate", "valid_from", "valid_upto"],
+        filters=[
+            ["Item Price", "item_code", "in", item_codes],
+            ["Item Price", "selling", "=", "1"],
+            ["Item Price", "price_list", "=", price_list],
+        ],
+        page_length=page_length,
+    )
+
+    today = str(date.today())
+    prices = {}
+    for price in rows:
+        valid_from = str(price.get("valid_from") or "")
+        valid_upto = str(price.get("valid_upto") or "")
+        if valid_from > today or (valid_upto and valid_upto < today):
+            continue
+
+        best = prices.get(price["item_code"])
+        if best is None or (valid_from, price["name"]) > best[0]:
+            prices[price["item_code"]] = ((valid_from, price["name"]), price)
+
+    return {code: price["price_list_rate"] for code, (_, price) in prices.items()}
+
+
+def get_documents(doc_class, doctype, names, erp_fields=("*",), chunk_size=100):
+    """
+    Return many `doctype` documents keyed by name, projected to
+    `erp_fields`, using one list query per `chunk_size` names. Unknown names
+    are left out. Child tables are not returned by list queries.
+    """
+    names = sorted(set(names))
+    erp_fields = list(erp_fields)
+    if "*" not in erp_fields and "name" not in erp_fields:
+        erp_fields.append("name")
+
+    documents = {}
+    for start in range(0, len(names), chunk_size):
+        chunk = names[start : start + chunk_size]
+        try:
+            found = erp_client.query(doc_class).list(
+                erp_fields=erp_fields,
+                filters=[[doctype, "name", "in", chunk]],
+                page_length=len(chunk),
+            )
+        except doc_class.DoesNotExist:
+            continue
+
+        documents.update((document["name"], document) for document in found)
+
+    return documents
+
+
+def get_customers(names, erp_fields=("name",)):
+    """
+    Return many customers keyed by name, see get_documents
+    """
+    return get_documents(ERPCustomer, "Customer", names, erp_fields=erp_fields)
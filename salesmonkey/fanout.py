@@ -0,0 +1,166 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import (
+    copy_current_request_context,
+    current_app,
+    g,
+    has_app_context,
+    has_request_context,
+)
+
+LOGGER = logging.getLogger(__name__)
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+_background = None
+_background_pid = None
+
+_local = threading.local()
+
+
+def get_executor():
+    """
+    Return the bounded thread pool of this worker process, (re)creating it
+    after a fork since threads do not survive it.
+    """
+    global _executor, _executor_pid
+
+    pid = os.getpid()
+    if _executor is None or _executor_pid != pid:
+        with _executor_lock:
+            if _executor is None or _executor_pid != pid:
+                max_workers = current_app.config.get(
+                    "ERP_FANOUT_WORKERS",
+                    current_app.config.get("ERPNEXT_POOL_MAXSIZE", 10),
+                )
+                _executor = ThreadPoolExecutor(
+                    max_workers=max_workers, thread_name_prefix="erp-fanout"
+                )
+                _executor_pid = pid
+
+    return _executor
+
+
+def submit_background(func):
+    """
+    Run func in the request (or app) context on the single background thread
+    of this worker process, outside the fan-out pool: work triggered by
+    webhooks never holds fan-out workers, whose nested fan-outs would wait on
+    the pool they occupy.
+    """
+    global _background, _background_pid
+
+    pid = os.getpid()
+    with _executor_lock:
+        if _background is None or _background_pid != pid:
+            _background = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="background"
+            )
+            _background_pid = pid
+
+    return _background.submit(in_context(func))
+
+
+def in_context(func):
+    """
+    Wrap func so it runs in a copy of the current request (or app) context
+    from another thread.
+    """
+    if has_request_context():
+        return copy_current_request_context(func)
+
+    app = current_app._get_current_object()
+
+    def wrapper(*args, **kwargs):
+        with app.app_context():
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def submit(func):
+    """
+    Run func on the fan-out pool in a copy of the current context. Fan-outs
+    nested inside it run inline, like those of fanned-out calls.
+    """
+
+    def run():
+        nested = getattr(_local, "in_fan_out", False)
+        _local.in_fan_out = True
+        try:
+            return func()
+        finally:
+            _local.in_fan_out = nested
+
+    return get_executor().submit(in_context(run))
+
+
+def _timed(name, func, timings):
+    def run():
+        nested = getattr(_local, "in_fan_out", False)
+        _local.in_fan_out = True
+        start = time.perf_counter()
+        try:
+            return func()
+        finally:
+            _local.in_fan_out = nested
+            timings[name] = time.perf_counter() - start
+
+    return run
+
+
+def fan_out(calls):
+    """
+    Run independent ERP calls concurrently and return their results keyed
+    like `calls`, a dict of name -> argument-less callable.
+
+    Calls keep the Flask request context and share erp_client. Per-call
+    timings are logged and appended to `g.erp_timings`. The first exception
+    raised by a call is re-raised once every call has finished. Fan-outs
+    nested inside a fanned-out call run inline to avoid starving the pool.
+    """
+    timings = {}
+    results = {}
+    error = None
+
+    if len(calls) < 2 or getattr(_local, "in_fan_out", False):
+        try:
+            for name, func in calls.items():
+                results[name] = _timed(name, func, timings)()
+        finally:
+            _record_timings(timings)
+        return results
+
+    executor = get_executor()
+    futures = {
+        name: executor.submit(in_context(_timed(name, func, timings)))
+        for name, func in calls.items()
+    }
+
+    for name, future in futures.items():
+        try:
+            results[name] = future.result()
+        except Exception as e:
+            if error is None:
+                error = e
+
+    _record_timings(timings)
+
+    if error is not None:
+        raise error
+
+    return results
+
+
+def _record_timings(timings):
+    for name, elapsed in timings.items():
+        LOGGER.debug("ERP call <{0}> took {1:.1f}ms".format(name, elapsed * 1000))
+
+    if has_app_context():
+        g.setdefault("erp_timings", []).extend(timings.items())
@@ -2,9 +2,53 @@ import functools
 
 import marshmallow
 
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.exceptions import HTTPException
+
 from flask_apispec import FlaskApiSpec, marshal_with, MethodResource
 
 
+class DetachedSession(dict, SessionMixin):
+    """
+    Empty session of session-free endpoints, never loaded nor saved
+    """
+
+
+class SessionlessInterface(SessionInterface):
+    """
+    Session interface skipping the wrapped one for the given endpoints:
+    no session store I/O and no Set-Cookie header on their responses
+    """
+
+    def __init__(self, session_interface, endpoints):
+        self.session_interface = session_interface
+        self.endpoints = endpoints
+
+    def _is_sessionless(self, app, request):
+        # Requests are routed after their session is opened
+        try:
+            endpoint, _ = app.create_url_adapter(request).match()
+        except HTTPException:
+            return False
+        return endpoint in self.endpoints
+
+    def open_session(self, app, request):
+        if self._is_sessionless(app, request):
+            return DetachedSession()
+        return self.session_interface.open_session(app, request)
+
+    def save_session(self, app, session, response):
+        if isinstance(session, DetachedSession):
+            return
+        return self.session_interface.save_session(app, session, response)
+
+    def make_null_session(self, app):
+        return self.session_interface.make_null_session(app)
+
+    def is_null_session(self, obj):
+        return self.session_interface.is_null_session(obj)
+
+
 class Api:
     """
     Holds a version of the API with documentation and allows routes to
@@ -14,24 +58,39 @@ class Api:
     def __init__(self, prefix=""):
         self.prefix = prefix
         self._deferred_routes = []
+        self._sessionless_endpoints = set()
+
+    def register(self, path, aMethodResource, session=True):
+        """
+        Route path to aMethodResource. Resources registered with
+        session=False never load nor save the user session: use it for
+        anonymous endpoints only.
+        """
+        name = aMethodResource.__module__ + "_" + aMethodResource.__name__.lower()
+        if not session:
+            self._sessionless_endpoints.add(name)
 
-    def register(self, path, aMethodResource):
         self._deferred_routes.append(
             (
                 "/{0}/{1}".format(self.prefix, path.lstrip("/")),
-                aMethodResource.as_view(
-                    name=aMethodResource.__module__
-                    + "_"
-                    + aMethodResource.__name__.lower()
-                ),
+                aMethodResource.as_view(name=name),
             )
         )
 
     def init_app(self, app):
+        """
+        Must run after the session extension is set up, to wrap its
+        session interface
+        """
         for deferred in self._deferred_routes:
             app.add_url_rule(deferred[0], view_func=deferred[1])
             specs.register(deferred[1])
 
+        if self._sessionless_endpoints:
+            app.session_interface = SessionlessInterface(
+                app.session_interface, self._sessionless_endpoints
+            )
+
 
 specs = FlaskApiSpec()
 api_v1 = Api(prefix="v0.1")
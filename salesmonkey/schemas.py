@@ -1,14 +1,16 @@
-from flask import session
+from flask import g, session
+from flask_login import current_user
 
 import satchless.item
 import satchless.cart
 
-from erpnext_client.documents import ERPItem, ERPBin
-
 from salesmonkey import ma
 
-from .erpnext import erp_client
+from .cart_store import cart_store
+from .erpnext import get_projected_qtys
 
+import hashlib
+import json
 import logging
 
 LOGGER = logging.getLogger(__name__)
@@ -28,21 +30,9 @@ class Item(satchless.item.StockedItem):
         return self.price
 
     def get_stock(self):
-        item = erp_client.query(ERPItem).get(self.code)
-
-        try:
-            bin = erp_client.query(ERPBin).first(
-                erp_fields=["projected_qty"],
-                filters=[
-                    ["Bin", "item_code", "=", self.code],
-                    ["Bin", "warehouse", "=", self.warehouse],
-                ],
-            )
-        except ERPBin.DoesNotExist:
-            # No warehouse entry equals ZERO stock
-            return 0
-
-        return max(bin["projected_qty"], 0)
+        # No warehouse entry equals ZERO stock
+        key = (self.code, self.warehouse)
+        return max(get_projected_qtys([key])[key], 0)
 
 
 class ItemSchema(ma.Schema):
@@ -65,14 +55,142 @@ class CartLineSchema(ma.Schema):
         return float(value)
 
 
+# Bump when the session form of the cart changes
+CART_FORMAT_VERSION = 1
+
+
 class Cart(satchless.cart.Cart):
+    """
+    View of the Redis cart of the current user: it is read once per request,
+    and each change is applied to Redis as one atomic line update.
+    Anonymous users get an empty cart that is not stored.
+    """
+
+    def __init__(self, items=None, owner=None):
+        super().__init__(items)
+        self.owner = owner
+
     @staticmethod
     def from_session():
-        cart = session.get("cart", None)
-        if cart is None:
-            session["cart"] = Cart()
+        if "cart" not in g:
+            owner = current_user.get_id() if current_user.is_authenticated else None
+            cart = Cart(owner=owner)
+            if owner is not None:
+                cart._migrate_session_cart()
+                cart._state = [
+                    cart.create_line(
+                        Item(code=code, name=name, warehouse=warehouse, price=price),
+                        quantity,
+                        None,
+                    )
+                    for code, name, warehouse, quantity, price in cart_store.lines(
+                        owner
+                    )
+                ]
+            g.cart = cart
+
+        return g.cart
+
+    def _migrate_session_cart(self):
+        """
+        Move a cart still kept in the session to the cart store. Concurrent
+        requests may carry the same session cart: it is merged once.
+        """
+        data = session.pop("cart", None)
+        if not data:
+            return
+
+        lines = [
+            (
+                line.product.code,
+                line.product.name,
+                line.product.warehouse,
+                line.quantity,
+                line.product.price,
+            )
+            for line in Cart.loads(data)
+        ]
+        if not lines:
+            return
+
+        merge_id = hashlib.sha1(
+            json.dumps([getattr(session, "sid", None), lines]).encode("utf-8")
+        ).hexdigest()
+        cart_store.merge(self.owner, lines, merge_id)
+
+    @classmethod
+    def loads(cls, data):
+        """
+        Cart from its former session forms: a pickled Cart, or a versioned
+        list of (code, name, warehouse, quantity, price) lines
+        """
+        cart = cls()
+
+        if isinstance(data, satchless.cart.Cart):
+            cart._state = list(data)
+        elif data:
+            version, lines = data
+            if version != CART_FORMAT_VERSION:
+                LOGGER.warning("Dropping cart of unknown format {0}".format(version))
+                return cart
+
+            for code, name, warehouse, quantity, price in lines:
+                cart._state.append(
+                    cart.create_line(
+                        Item(code=code, name=name, warehouse=warehouse, price=price),
+                        quantity,
+                        None,
+                    )
+                )
+
+        return cart
+
+    def add(self, product, quantity=1, data=None, replace=False, check_quantity=True):
+        if self.owner is None or replace:
+            # Validate against this request's view first, like satchless does
+            super().add(
+                product,
+                quantity=quantity,
+                data=data,
+                replace=replace,
+                check_quantity=check_quantity,
+            )
 
-        return session.get("cart")
+        if self.owner is None:
+            return
+
+        if replace:
+            cart_store.set(
+                self.owner,
+                product.code,
+                quantity,
+                product.name,
+                product.warehouse,
+                product.price,
+            )
+            return
+
+        # Concurrent requests may have changed the line: the stock bound is
+        # checked by the store against the stored total, atomically
+        new_quantity, added = cart_store.increment(
+            self.owner,
+            product.code,
+            quantity,
+            product.name,
+            product.warehouse,
+            product.price,
+            max_quantity=product.get_stock() if check_quantity else None,
+        )
+        if not added:
+            raise satchless.item.InsufficientStock(product)
+
+        super().add(product, quantity=new_quantity, replace=True, check_quantity=False)
+
+    def clear(self):
+        super().clear()
+
+        if self.owner is not None:
+            cart_store.clear(self.owner)
 
     @property
     def items(self):
@@ -82,6 +200,9 @@ class Cart(satchless.cart.Cart):
 class CartSchema(ma.Schema):
     items = ma.Nested(CartLineSchema, many=True)
     grand_total = ma.Method("get_grand_total", deserialize="load_grand_total")
+    # Set on carts with shipping and taxes evaluated
+    shipping_cost = ma.Float()
+    order_total = ma.Float()
 
     def get_grand_total(self, obj):
         return obj.get_total()
@@ -0,0 +1,172 @@
+import functools
+import logging
+
+from erpnext_client.documents import ERPItem, ERPSalesOrder
+from erpnext_client.schemas import ERPSalesOrderSchema
+
+from flask import session
+
+from ..erpnext import erp_client, get_documents, get_projected_qtys
+from ..fanout import fan_out
+from .rules import get_order_rules
+
+LOGGER = logging.getLogger(__name__)
+
+# Made to order, never checked against stock
+STOCKLESS_ITEM_GROUPS = ("BrewLab",)
+
+
+def check_stock(lines):
+    """
+    Check (item_code, warehouse, qty) lines against projected stock with one
+    Bin query. Returns the lines short of stock as dicts with their
+    item_code, warehouse, requested, available and shortfall quantities.
+    """
+    requested = {}
+    for item_code, warehouse, qty in lines:
+        key = (item_code, warehouse)
+        requested[key] = requested.get(key, 0) + qty
+
+    if not requested:
+        return []
+
+    results = fan_out(
+        {
+            "qtys": functools.partial(get_projected_qtys, requested.keys()),
+            "items": functools.partial(
+                get_documents,
+                ERPItem,
+                "Item",
+                [item_code for item_code, warehouse in requested],
+                erp_fields=["name", "item_group"],
+            ),
+        }
+    )
+
+    shortfalls = []
+    for (item_code, warehouse), qty in requested.items():
+        item = results["items"].get(item_code, {})
+        if item.get("item_group") in STOCKLESS_ITEM_GROUPS:
+            continue
+
+        available = max(0, results["qtys"][(item_code, warehouse)])
+        if qty > available:
+            shortfalls.append(
+                {
+                    "item_code": item_code,
+                    "warehouse": warehouse,
+                    "requested": qty,
+                    "available": available,
+                    "shortfall": qty - available,
+                }
+            )
+
+    return shortfalls
+
+
+class SalesOrderBuilder:
+    """
+    Sales Order items with their shipping and tax rows computed locally from
+    the ERP rules, so the whole order is written to ERP in a single call
+    """
+
+    def __init__(self, shipping_rule):
+        self.shipping_rule = shipping_rule
+        self.items = []
+
+    def add_item(self, item_code, qty, rate, warehouse):
+        self.items.append(
+            {"item_code": item_code, "qty": qty, "rate": rate, "warehouse": warehouse}
+        )
+
+    @property
+    def amount_total(self):
+        return sum(item["qty"] * float(item["rate"]) for item in self.items)
+
+    def taxes(self):
+        taxes, shipping_cost, grand_total = get_order_rules().evaluate(
+            self.shipping_rule, self.amount_total
+        )
+        return taxes
+
+    def data(self, **fields):
+        data = {
+            "shipping_rule": self.shipping_rule,
+            "items": self.items,
+            "taxes": self.taxes(),
+        }
+        data.update(fields)
+        return data
+
+
+def _load(response):
+    response.raise_for_status()
+    sales_order, errors = ERPSalesOrderSchema(strict=True).load(
+        data=response.json()["data"]
+    )
+    return sales_order
+
+
+def create_sales_order(data):
+    return _load(erp_client.create_resource("Sales Order", data=data))
+
+
+def update_sales_order(name, data):
+    return _load(erp_client.query(ERPSalesOrder).update(name=name, data=data))
+
+
+def find_draft_sales_order(customer_name):
+    """
+    Return the (name, shipping_rule) of the shopping cart Sales Order of a
+    customer that is still a draft, remembered in the session once known
+    """
+    draft = session.get("draft_sales_order")
+    if draft is not None and draft["customer"] == customer_name:
+        return draft["name"], draft["shipping_rule"]
+
+    try:
+        sales_order = erp_client.query(ERPSalesOrder).first(
+            erp_fields=["name", "shipping_rule"],
+            filters=[
+                ["Sales Order", "order_type", "=", "Shopping Cart"],
+                ["Sales Order", "status", "=", "Draft"],
+                ["Sales Order", "customer", "=", customer_name],
+            ],
+        )
+    except ERPSalesOrder.DoesNotExist:
+        return None, None
+
+    remember_draft_sales_order(
+        customer_name, sales_order["name"], sales_order["shipping_rule"]
+    )
+    return sales_order["name"], sales_order["shipping_rule"]
+
+
+def is_draft_sales_order(name):
+    """
+    Whether a Sales Order still exists and is a draft (docstatus 0)
+    """
+    try:
+        erp_client.query(ERPSalesOrder).first(
+            erp_fields=["name"],
+            filters=[
+                ["Sales Order", "name", "=", name],
+                ["Sales Order", "docstatus", "=", "0"],
+            ],
+        )
+    except ERPSalesOrder.DoesNotExist:
+        return False
+
+    return True
+
+
+def remember_draft_sales_order(customer_name, name, shipping_rule):
+    session["draft_sales_order"] = {
+        "customer": customer_name,
+        "name": name,
+        "shipping_rule": shipping_rule,
+    }
+
+
+def forget_draft_sales_order():
+    session.pop("draft_sales_order", None)
@@ -5,13 +5,12 @@ from random import randint
 
 import requests
 import satchless
-from erpnext_client.documents import (ERPBin, ERPContact, ERPCustomer,
-                                      ERPDynamicLink, ERPItem, ERPItemPrice,
-                                      ERPJournalEntry, ERPSalesOrder, ERPUser)
+from erpnext_client.documents import (ERPCustomer, ERPItem, ERPJournalEntry,
+                                      ERPSalesOrder, ERPUser)
 from erpnext_client.schemas import (ERPCustomerSchema, ERPItemSchema,
                                     ERPSalesOrderItemSchema,
                                     ERPSalesOrderSchema)
-from flask import session
+from flask import jsonify, session
 from flask_apispec import (FlaskApiSpec, MethodResource, marshal_with,
                            use_kwargs)
 from flask_login import current_user, login_required
@@ -20,23 +19,21 @@ from webargs import fields
 from webargs.flaskparser import use_args
 from werkzeug.exceptions import BadRequest, Conflict, Gone, NotFound
 
-from ..erpnext import erp_client
+from ..auth.identity import current_customer
+from ..erpnext import erp_client, get_item_prices, get_projected_qtys
+from ..fanout import fan_out
 from ..rest import api_v1
 from ..schemas import Cart, CartLineSchema, CartSchema, Item
-from ..utils import OrderNumberGenerator
+from ..utils import OrderNumberGenerator, doc_tag
+from .orders import (SalesOrderBuilder, check_stock, create_sales_order,
+                     find_draft_sales_order, forget_draft_sales_order,
+                     is_draft_sales_order, remember_draft_sales_order,
+                     update_sales_order)
+from .rules import get_order_rules
 
 LOGGER = logging.getLogger(__name__)
 
-
-def calculate_shipping_cost(sales_order):
-    shipping_cost = 0
-    if sales_order["shipping_rule"] == "Emport Brasserie":
-        return 0
-
-    if int(sales_order["amount_total"]) < 50:
-        shipping_cost = 5
-
-    return shipping_cost
+WEB_PRICE_LIST = app.config.get("ERPNEXT_PRICE_LIST", "Tarifs standards TTC")
 
 
 class GiveAway(MethodResource):
@@ -121,7 +118,17 @@ class CartDetail(MethodResource):
 
     @marshal_with(CartSchema)
     def get(self, **kwargs):
-        return Cart.from_session()
+        cart = Cart.from_session()
+
+        # Live totals, with the shipping rule of the current order if any
+        if cart:
+            draft = session.get("draft_sales_order") or {}
+            taxes, cart.shipping_cost, cart.order_total = get_order_rules().evaluate(
+                draft.get("shipping_rule") or app.config["ERPNEXT_SHIPPING_RULE"],
+                cart.get_total(),
+            )
+
+        return cart
 
     @login_required
     @use_kwargs({"item_code": fields.Str()})
@@ -144,94 +151,80 @@ class CartDetail(MethodResource):
         if cart.count() <= 0:
             raise BadRequest("Empty cart")
 
-        items = [
-            {
-                "item_code": line.product.code,
-                "qty": line.quantity,
-                "warehouse": line.product.warehouse,
-            }
-            for line in cart
+        customer = current_customer()
+        if customer is None:
+            raise NotFound
+
+        # Never write an order we cannot deliver: report every short line
+        shortfalls = check_stock(
+            (line.product.code, line.product.warehouse, line.quantity) for line in cart
+        )
+        if shortfalls:
+            response = jsonify(shortfalls=shortfalls)
+            response.status_code = 409
+            raise Conflict(response=response)
+
+        # Prices may have changed in ERP since items were put in the cart
+        # FIXME: Should lookup current user price group
+        prices = get_item_prices([line.product.code for line in cart], WEB_PRICE_LIST)
+        unpriced = [
+            line.product.code for line in cart if line.product.code not in prices
         ]
+        if unpriced:
+            response = jsonify(unpriced=unpriced)
+            response.status_code = 409
+            raise Conflict(response=response)
+
+        draft_name, shipping_rule = find_draft_sales_order(customer["name"])
 
-        # FIXME We should check the quantities!
+        builder = SalesOrderBuilder(
+            shipping_rule or app.config["ERPNEXT_SHIPPING_RULE"]
+        )
+        for line in cart:
+            builder.add_item(
+                line.product.code,
+                line.quantity,
+                prices[line.product.code],
+                line.product.warehouse,
+            )
 
         # Place SO
         # FIXME OrderNumberGenerator not used?
         num_gen = OrderNumberGenerator()
 
-        # Delete previous shopping cart if prevent
-        try:
-            current_sales_order = erp_client.query(ERPSalesOrder).first(
-                erp_fields=["name"],
-                filters=[
-                    ["Sales Order", "order_type", "=", "Shopping Cart"],
-                    ["Sales Order", "status", "=", "Draft"],
-                    ["Sales Order", "customer", "=", session["customer"]["name"]],
-                ],
-            )
-
-            response = erp_client.query(ERPSalesOrder).update(
-                name=current_sales_order["name"], data={"items": items}
-            )
-
-        except ERPSalesOrder.DoesNotExist:
-            # No previous SO, create a new one
-
-            response = erp_client.create_resource(
-                "Sales Order",
-                data={
-                    "customer": session["customer"]["name"],
-                    "title": "Commande Web {0} {1}".format(
-                        current_user.first_name, current_user.last_name
-                    ),
-                    "shipping_rule": app.config["ERPNEXT_SHIPPING_RULE"],
-                    "naming_series": "SO-WEB-.YY.MM.DD.-.###",
-                    "set_warehouse": "Vente en Ligne - LSS",
-                    "order_type": "Shopping Cart",
-                    "items": items,
-                    "taxes": [],
-                },
-            )
-
-        if response.ok:
-            # Empty Cart once SO has been placed
-            # XXX cart.clear()
-            sales_order, errors = ERPSalesOrderSchema(strict=True).load(
-                data=response.json()["data"]
-            )
-
-            shipping_cost = calculate_shipping_cost(sales_order)
-
-            response = erp_client.update_resource(
-                "Sales Order",
-                resource_name=sales_order["name"],
-                data={
-                    "taxes": [
-                        {
-                            "charge_type": "On Net Total",
-                            "account_head": "445710 - TVA collectée - LSS",
-                            "description": "TVA 20%",
-                            "included_in_print_rate": "1",
-                            "rate": "20",
-                        },
-                        {
-                            "charge_type": "Actual",
-                            "account_head": "7085 - Ports et frais accessoires facturés - LSS",
-                            "description": "Livraison",
-                            "rate": "0",
-                            "tax_amount": shipping_cost,
-                        },
-                    ]
-                },
-            )
-
-            sales_order, errors = ERPSalesOrderSchema(strict=True).load(
-                data=response.json()["data"]
+        # Update the current shopping cart SO, taxes included, in one call
+        if draft_name is not None:
+            try:
+                return update_sales_order(draft_name, builder.data())
+            except ERPSalesOrder.DoesNotExist:
+                pass
+            except requests.HTTPError as e:
+                # Only a deleted or submitted draft calls for a new order,
+                # any other error would leave a duplicate one in ERP
+                if e.response.status_code != requests.codes.not_found:
+                    if is_draft_sales_order(draft_name):
+                        raise
+
+            LOGGER.info("Sales Order <{0}> is no longer a draft".format(draft_name))
+            forget_draft_sales_order()
+
+        # No previous SO, create a new one
+        sales_order = create_sales_order(
+            builder.data(
+                customer=customer["name"],
+                title="Commande Web {0} {1}".format(
+                    current_user.first_name, current_user.last_name
+                ),
+                naming_series="SO-WEB-.YY.MM.DD.-.###",
+                set_warehouse="Vente en Ligne - LSS",
+                order_type="Shopping Cart",
             )
+        )
+        remember_draft_sales_order(
+            customer["name"], sales_order["name"], builder.shipping_rule
+        )
 
-            return sales_order
-        else:
-            response.raise_for_error()
+        return sales_order
 
 
 api_v1.register("/shop/cart/", CartDetail)
@@ -240,7 +233,7 @@ api_v1.register("/shop/cart/", CartDetail)
 @marshal_with(ERPItemSchema(many=True))
 class ItemList(MethodResource):
     @use_kwargs({"item_group": fields.Str()})
-    @cache.memoize(timeout=5)
+    @cache.memoize(timeout=60 * 60, stale_ttl=60, tags=[doc_tag("Item")])
     def get(self, **kwargs):
         item_group = kwargs.get("item_group", None)
 
@@ -266,7 +259,7 @@ class ItemList(MethodResource):
         return items
 
 
-api_v1.register("/shop/items/", ItemList)
+api_v1.register("/shop/items/", ItemList, session=False)
 
 
 class ShopItemSchema(ERPItemSchema):
@@ -278,9 +271,24 @@ class ShopItemSchema(ERPItemSchema):
     variants = fields.Nested("ShopItemSchema", many=True)
 
 
+def _item_detail_tags(item, *args, **kwargs):
+    """
+    ERP documents an ItemDetail entry depends on
+    """
+    tags = [doc_tag("Item", item["code"]), doc_tag("Bin", item["code"])]
+    for item_variant in item.get("variants", []):
+        tags += [
+            doc_tag("Item", item_variant["code"]),
+            doc_tag("Bin", item_variant["code"]),
+            doc_tag("Item Price", item_variant["code"]),
+        ]
+
+    return tags
+
+
 class ItemDetail(MethodResource):
     @marshal_with(ShopItemSchema)
-    @cache.memoize(timeout=10)
+    @cache.memoize(timeout=60 * 60, tags=_item_detail_tags)
     def get(self, name):
         try:
             item = erp_client.query(ERPItem).get(name)
@@ -305,65 +313,38 @@ class ItemDetail(MethodResource):
                 LOGGER.debug(item_variants)
                 item["variants"] = item_variants
 
-                # Fetch variant quantity
-                for item_variant in item_variants:
-                    try:
-                        bin = erp_client.query(ERPBin).first(
-                            erp_fields=["name", "projected_qty"],
-                            filters=[
-                                ["Bin", "item_code", "=", item_variant["code"]],
-                                [
-                                    "Bin",
-                                    "warehouse",
-                                    "=",
-                                    item_variant["website_warehouse"],
-                                ],
-                            ],
-                        )
+                # Fetch every variant quantity and price in one query each,
+                # both at once
+                # FIXME: Should lookup current user price group
+                variant_codes = [item_variant["code"] for item_variant in item_variants]
+                results = fan_out(
+                    {
+                        "qtys": lambda: get_projected_qtys(
+                            (item_variant["code"], item_variant["website_warehouse"])
+                            for item_variant in item_variants
+                        ),
+                        "prices": lambda: get_item_prices(
+                            variant_codes, WEB_PRICE_LIST
+                        ),
+                    }
+                )
+                qtys, prices = results["qtys"], results["prices"]
 
-                        item_variant["orderable_qty"] = max(bin["projected_qty"], 0)
-                    except ERPBin.DoesNotExist:
-                        # If we have no Bin, it means, there was no stock movement there so it equals to zero stock
-                        item_variant["orderable_qty"] = 0
+                for item_variant in item_variants:
+                    key = (item_variant["code"], item_variant["website_warehouse"])
+                    item_variant["orderable_qty"] = max(qtys[key], 0)
 
-                    # Get price for current customer
-                    # FIXME: Should lookup current user price group
                     try:
-                        variant_price = erp_client.query(ERPItemPrice).first(
-                            erp_fields=["price_list_rate"],
-                            filters=[
-                                ["Item Price", "item_code", "=", item_variant["code"]],
-                                ["Item Price", "selling", "=", "1"],
-                                [
-                                    "Item Price",
-                                    "price_list",
-                                    "=",
-                                    "Tarifs standards TTC",
-                                ],
-                            ],
-                        )
-
-                        item_variant["price"] = variant_price["price_list_rate"]
-                    except ERPItemPrice.DoesNotExist:
+                        item_variant["price"] = prices[item_variant["code"]]
+                    except KeyError:
                         LOGGER.debug(
                             "No price list for Item <{0}>".format(item_variant["code"])
                         )
                         raise BadRequest
             else:
                 # Fetch item qtty
-                try:
-                    bin = erp_client.query(ERPBin).first(
-                        erp_fields=["name", "projected_qty"],
-                        filters=[
-                            ["Bin", "item_code", "=", item["code"]],
-                            ["Bin", "warehouse", "=", item["website_warehouse"]],
-                        ],
-                    )
-
-                    item["orderable_qty"] = max(bin["projected_qty"], 0)
-                except ERPBin.DoesNotExist:
-                    # If we have no Bin, it means, there was no stock movement there so it equals to zero stock
-                    item["orderable_qty"] = 0
+                key = (item["code"], item["website_warehouse"])
+                item["orderable_qty"] = max(get_projected_qtys([key])[key], 0)
 
         except ERPItem.DoesNotExist:
             raise NotFound
@@ -382,20 +363,11 @@ class ItemDetail(MethodResource):
 
             # Get price for current customer
             # FIXME: Should lookup current user price group
+            prices = get_item_prices([item["code"]], WEB_PRICE_LIST)
             try:
-                variant_price = erp_client.query(ERPItemPrice).first(
-                    erp_fields=["price_list_rate"],
-                    filters=[
-                        ["Item Price", "item_code", "=", item["code"]],
-                        ["Item Price", "selling", "=", "1"],
-                        ["Item Price", "price_list", "=", "Tarifs standards TTC"],
-                    ],
-                )
-                item["price"] = variant_price["price_list_rate"]
-            except ERPItemPrice.DoesNotExist:
-                LOGGER.debug(
-                    "No price list for Item <{0}>".format(item_variant["code"])
-                )
+                item["price"] = prices[item["code"]]
+            except KeyError:
+                LOGGER.debug("No price list for Item <{0}>".format(item["code"]))
                 raise NotFound
 
         except ERPItem.DoesNotExist:
@@ -418,7 +390,6 @@ class ItemDetail(MethodResource):
         )
 
         try:
-            product.check_quantity(quantity)
             cart.add(product, quantity=quantity, replace=False)
         except satchless.item.InsufficientStock as e:
             quantity = e.item.get_stock()
@@ -432,25 +403,9 @@ api_v1.register("/shop/items/<name>", ItemDetail)
 class UserSalesOrderList(MethodResource):
     @login_required
     def get(self):
-        # FIXME duplicate code
-        contact = erp_client.query(ERPContact).first(
-            filters=[["Contact", "user", "=", current_user.username]],
-            erp_fields=["name", "first_name", "last_name"],
-        )
-
-        link = erp_client.query(ERPDynamicLink).first(
-            filters=[
-                ["Dynamic Link", "parenttype", "=", "Contact"],
-                ["Dynamic Link", "parent", "=", contact["name"]],
-                ["Dynamic Link", "parentfield", "=", "links"],
-            ],
-            erp_fields=["name", "link_name", "parent", "parenttype"],
-            parent="Contact",
-        )
-
-        customer = erp_client.query(ERPCustomer).first(
-            filters=[["Customer", "name", "=", link["link_name"]]]
-        )
+        customer = current_customer()
+        if customer is None:
+            raise NotFound
 
         sales_orders = erp_client.query(ERPSalesOrder).list(
             erp_fields=["name", "grand_total", "title", "customer", "transaction_date"],
@@ -478,30 +433,14 @@ class UserSalesOrderDetail(MethodResource):
     @login_required
     @use_kwargs({"update_qttys": fields.Boolean(missing=False)})
     def get(self, name, update_qttys):
-        # FIXME duplicate code
-        contact = erp_client.query(ERPContact).first(
-            filters=[["Contact", "user", "=", current_user.username]],
-            erp_fields=["name", "first_name", "last_name"],
-        )
-
-        link = erp_client.query(ERPDynamicLink).first(
-            filters=[
-                ["Dynamic Link", "parenttype", "=", "Contact"],
-                ["Dynamic Link", "parent", "=", contact["name"]],
-                ["Dynamic Link", "parentfield", "=", "links"],
-            ],
-            erp_fields=["name", "link_name", "parent", "parenttype"],
-            parent="Contact",
-        )
-
-        customer = erp_client.query(ERPCustomer).first(
-            filters=[["Customer", "name", "=", link["link_name"]]]
-        )
+        customer = current_customer()
+        if customer is None:
+            raise NotFound
 
         try:
             sales_order = erp_client.query(ERPSalesOrder).get(
                 name,
-                fields='["name", "title", "grand_total", "customer", "items", "transaction_date"]',
+                fields='["name", "title", "grand_total", "customer", "items", "transaction_date", "shipping_rule"]',
                 filters=[
                     ["Sales Order", "Customer", "=", customer["name"]],
                     ["Sales Order", "status", "!=", "Cancelled"],
@@ -513,7 +452,7 @@ class UserSalesOrderDetail(MethodResource):
 
                 need_updating = False
 
-                updated_items = []
+                builder = SalesOrderBuilder(sales_order["shipping_rule"])
 
                 for item in sales_order["items"]:
                     # XXX Hardcoded cateogry group!
@@ -526,14 +465,15 @@ class UserSalesOrderDetail(MethodResource):
                         new_qtty = item["quantity"]
 
                     if new_qtty > 0:
-                        updated_items.append(
-                            {"item_code": item["item_code"], "qty": new_qtty}
+                        builder.add_item(
+                            item["item_code"], new_qtty, item["rate"], item["warehouse"]
                         )
 
                 if need_updating == True:
                     # We delete our SO since nothing is available anymore
-                    if len(updated_items) == 0:
+                    if len(builder.items) == 0:
                         erp_client.query(ERPSalesOrder).delete(name)
+                        forget_draft_sales_order()
                         # Empty Cart
                         cart = Cart.from_session()
                         cart.clear()
@@ -545,45 +485,8 @@ class UserSalesOrderDetail(MethodResource):
                         )
                     )
 
-                    # Update SO
-                    response = erp_client.query(ERPSalesOrder).update(
-                        name, data={"items": updated_items}
-                    )
-
-                    sales_order, errors = ERPSalesOrderSchema(strict=True).load(
-                        data=response.json()["data"]
-                    )
-                    LOGGER.debug(sales_order)
-
-                    # FIXME HARDCODED!
-                    shipping_cost = calculate_shipping_cost(sales_order)
-
-                    response = erp_client.update_resource(
-                        "Sales Order",
-                        resource_name=sales_order["name"],
-                        data={
-                            "taxes": [
-                                {
-                                    "charge_type": "On Net Total",
-                                    "account_head": "445710 - TVA collectée - LSS",
-                                    "description": "TVA 20%",
-                                    "included_in_print_rate": "1",
-                                    "rate": "20",
-                                },
-                                {
-                                    "charge_type": "Actual",
-                                    "account_head": "7085 - Ports et frais accessoires facturés - LSS",
-                                    "description": "Livraison",
-                                    "rate": "0",
-                                    "tax_amount": shipping_cost,
-                                },
-                            ]
-                        },
-                    )
-
-                    sales_order, errors = ERPSalesOrderSchema(strict=True).load(
-                        data=response.json()["data"]
-                    )
+                    # Update SO, taxes included
+                    sales_order = update_sales_order(name, builder.data())
 
                     # Update Cart based on new SO
                     cart = Cart.from_session()
@@ -618,25 +521,9 @@ class UserSalesOrderShippingMethod(MethodResource):
         """
         Retrieve the shipping method
         """
-        # FIXME duplicate code
-        contact = erp_client.query(ERPContact).first(
-            filters=[["Contact", "user", "=", current_user.username]],
-            erp_fields=["name", "first_name", "last_name"],
-        )
-
-        link = erp_client.query(ERPDynamicLink).first(
-            filters=[
-                ["Dynamic Link", "parenttype", "=", "Contact"],
-                ["Dynamic Link", "parent", "=", contact["name"]],
-                ["Dynamic Link", "parentfield", "=", "links"],
-            ],
-            erp_fields=["name", "link_name", "parent", "parenttype"],
-            parent="Contact",
-        )
-
-        customer = erp_client.query(ERPCustomer).first(
-            filters=[["Customer", "name", "=", link["link_name"]]]
-        )
+        customer = current_customer()
+        if customer is None:
+            raise NotFound
 
         try:
             sales_order = erp_client.query(ERPSalesOrder).get(
@@ -661,8 +548,8 @@ class UserSalesOrderShippingMethod(MethodResource):
         """
         Set the shipping method
         """
-        customer = session.get("customer", None)
-        if not customer:
+        customer = current_customer()
+        if customer is None:
             raise NotFound
 
         if shipping_method not in ("drive", "shipping"):
@@ -673,6 +560,9 @@ class UserSalesOrderShippingMethod(MethodResource):
         except ERPSalesOrder.DoesNotExist:
             raise NotFound
 
+        if sales_order["customer"] != customer["name"]:
+            raise NotFound
+
         if sales_order["status"] != "Draft":
             raise NotAllowed
 
@@ -684,31 +574,16 @@ class UserSalesOrderShippingMethod(MethodResource):
         except KeyError:
             raise NotAllowed
 
-        sales_order["shipping_rule"] = erp_shipping_rule
-        shipping_cost = calculate_shipping_cost(sales_order)
-
-        taxes = [
-            {
-                "charge_type": "On Net Total",
-                "account_head": "445710 - TVA collectée - LSS",
-                "description": "TVA 20%",
-                "included_in_print_rate": "1",
-                "rate": "20",
-            },
-            {
-                "charge_type": "Actual",
-                "account_head": "7085 - Ports et frais accessoires facturés - LSS",
-                "description": "Livraison",
-                "rate": "0",
-                "tax_amount": shipping_cost,
-            },
-        ]
+        builder = SalesOrderBuilder(erp_shipping_rule)
+        for item in sales_order["items"]:
+            builder.add_item(
+                item["item_code"], item["quantity"], item["rate"], item["warehouse"]
+            )
 
-        erp_client.query(ERPSalesOrder).update(
-            name, {"shipping_rule": erp_shipping_rule, "taxes": taxes}
-        )
+        sales_order = update_sales_order(name, builder.data())
+        remember_draft_sales_order(customer["name"], name, erp_shipping_rule)
 
-        return erp_client.query(ERPSalesOrder).get(name)
+        return sales_order
 
 
 api_v1.register("/shop/orders/<name>/shipping", UserSalesOrderShippingMethod)
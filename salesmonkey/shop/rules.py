@@ -0,0 +1,242 @@
+import logging
+import threading
+import time
+import uuid
+
+from salesmonkey import app, cache
+
+from ..erpnext import erp_client, ERPSalesTaxesAndChargesTemplate, ERPShippingRule
+from ..utils import doc_tag
+
+LOGGER = logging.getLogger(__name__)
+
+TAX_ROW_FIELDS = (
+    "charge_type",
+    "account_head",
+    "description",
+    "rate",
+    "tax_amount",
+    "included_in_print_rate",
+    "cost_center",
+)
+
+
+class ShippingRule:
+    """
+    Local copy of an ERP Shipping Rule, evaluated the way ERPNext does
+    """
+
+    def __init__(self, doc):
+        self.name = doc["name"]
+        self.label = doc.get("label") or doc["name"]
+        self.based_on = doc.get("calculate_based_on", "Fixed")
+        self.amount = float(doc.get("shipping_amount") or 0)
+        self.account = doc.get("account")
+        self.cost_center = doc.get("cost_center")
+        self.conditions = [
+            (
+                float(condition.get("from_value") or 0),
+                float(condition.get("to_value") or 0),
+                float(condition.get("shipping_amount") or 0),
+            )
+            for condition in doc.get("conditions", [])
+        ]
+
+    def cost(self, net_total):
+        if self.based_on == "Fixed":
+            return self.amount
+
+        if self.based_on != "Net Total":
+            LOGGER.warning(
+                "Shipping Rule <{0}> based on {1} is not supported".format(
+                    self.name, self.based_on
+                )
+            )
+            return 0.0
+
+        # First matching condition, one without upper bound matches anything
+        for from_value, to_value, amount in self.conditions:
+            if not to_value or from_value <= net_total <= to_value:
+                return amount
+
+        return 0.0
+
+    def tax_row(self, net_total):
+        row = {
+            "charge_type": "Actual",
+            "account_head": self.account,
+            "description": self.label,
+            "tax_amount": self.cost(net_total),
+        }
+        if self.cost_center:
+            row["cost_center"] = self.cost_center
+        return row
+
+
+class TaxTemplate:
+    """
+    Local copy of an ERP Sales Taxes and Charges Template
+    """
+
+    def __init__(self, doc):
+        self.name = doc["name"]
+        self.rows = [
+            {
+                field: row[field]
+                for field in TAX_ROW_FIELDS
+                if row.get(field) is not None
+            }
+            for row in doc.get("taxes", [])
+        ]
+
+    def _net_total_rates(self, included):
+        return sum(
+            float(row.get("rate") or 0)
+            for row in self.rows
+            if row["charge_type"] == "On Net Total"
+            and bool(int(row.get("included_in_print_rate") or 0)) == included
+        )
+
+    def net_total(self, amount_total):
+        """
+        Net total of items priced `amount_total`, tax included rows removed
+        """
+        return amount_total / (1 + self._net_total_rates(included=True) / 100)
+
+    def grand_total(self, amount_total):
+        extra_rate = self._net_total_rates(included=False)
+        actual = sum(
+            float(row.get("tax_amount") or 0)
+            for row in self.rows
+            if row["charge_type"] == "Actual"
+        )
+        return amount_total + self.net_total(amount_total) * extra_rate / 100 + actual
+
+
+class OrderRules:
+    """
+    Shipping rules and sales taxes of the shop, evaluated in process
+    """
+
+    def __init__(self, shipping_rules, tax_template):
+        self.shipping_rules = {doc["name"]: ShippingRule(doc) for doc in shipping_rules}
+        self.tax_template = TaxTemplate(tax_template or {"name": None, "taxes": []})
+
+    def evaluate(self, shipping_rule, amount_total):
+        """
+        Return (taxes, shipping_cost, grand_total) of items priced
+        `amount_total` and shipped with `shipping_rule`: taxes are Sales
+        Order tax rows, shipping row last
+        """
+        taxes = [dict(row) for row in self.tax_template.rows]
+        grand_total = self.tax_template.grand_total(amount_total)
+
+        rule = self.shipping_rules.get(shipping_rule)
+        if rule is None:
+            LOGGER.warning("Unknown Shipping Rule <{0}>".format(shipping_rule))
+            return taxes, 0.0, grand_total
+
+        shipping_row = rule.tax_row(self.tax_template.net_total(amount_total))
+        taxes.append(shipping_row)
+
+        return (
+            taxes,
+            shipping_row["tax_amount"],
+            grand_total + shipping_row["tax_amount"],
+        )
+
+
+@cache.memoize(
+    timeout=60 * 60 * 24,
+    tags=[doc_tag("Shipping Rule"), doc_tag("Sales Taxes and Charges Template")],
+)
+def _get_rule_documents():
+    """
+    Selling Shipping Rules and the sales taxes template of the shop, with
+    their child tables
+    """
+    try:
+        names = erp_client.query(ERPShippingRule).list(
+            erp_fields=["name"],
+            filters=[
+                ["Shipping Rule", "disabled", "=", "0"],
+                ["Shipping Rule", "shipping_rule_type", "=", "Selling"],
+            ],
+        )
+    except ERPShippingRule.DoesNotExist:
+        names = []
+
+    # List queries do not return child tables (conditions)
+    shipping_rules = [
+        erp_client.query(ERPShippingRule).get(rule["name"]) for rule in names
+    ]
+
+    template_name = app.config.get("ERPNEXT_TAXES_TEMPLATE")
+    try:
+        if template_name is None:
+            template_name = erp_client.query(ERPSalesTaxesAndChargesTemplate).first(
+                erp_fields=["name"],
+                filters=[
+                    ["Sales Taxes and Charges Template", "is_default", "=", "1"],
+                    ["Sales Taxes and Charges Template", "disabled", "=", "0"],
+                ],
+            )["name"]
+        tax_template = erp_client.query(ERPSalesTaxesAndChargesTemplate).get(
+            template_name
+        )
+    except ERPSalesTaxesAndChargesTemplate.DoesNotExist:
+        LOGGER.warning("No Sales Taxes and Charges Template for the shop")
+        tax_template = None
+
+    return shipping_rules, tax_template
+
+
+@cache.memoize(
+    timeout=60 * 60 * 24,
+    tags=[doc_tag("Shipping Rule"), doc_tag("Sales Taxes and Charges Template")],
+)
+def _rules_version():
+    """
+    Id renewed whenever the rule documents are purged from the cache
+    """
+    return uuid.uuid4().hex
+
+
+ORDER_RULES_CHECK_INTERVAL = app.config.get("ORDER_RULES_CHECK_INTERVAL", 5)
+
+_order_rules = None
+_order_rules_version = None
+_order_rules_checked_at = None
+_order_rules_lock = threading.Lock()
+
+
+def get_order_rules():
+    """
+    OrderRules of this process, rebuilt from the cached ERP documents only
+    when their version changes. The version is read at most every
+    ORDER_RULES_CHECK_INTERVAL seconds, other calls cost nothing.
+    """
+    global _order_rules, _order_rules_version, _order_rules_checked_at
+
+    if (
+        _order_rules is not None
+        and time.monotonic() - _order_rules_checked_at < ORDER_RULES_CHECK_INTERVAL
+    ):
+        return _order_rules
+
+    with _order_rules_lock:
+        now = time.monotonic()
+        if (
+            _order_rules is not None
+            and now - _order_rules_checked_at < ORDER_RULES_CHECK_INTERVAL
+        ):
+            return _order_rules
+
+        # Read before the documents: a purge meanwhile only costs a rebuild
+        version = _rules_version()
+        if _order_rules is None or version != _order_rules_version:
+            _order_rules = OrderRules(*_get_rule_documents())
+            _order_rules_version = version
+        _order_rules_checked_at = now
+
+        return _order_rules
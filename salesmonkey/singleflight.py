@@ -0,0 +1,169 @@
+import hashlib
+import logging
+import pickle
+import threading
+import time
+import uuid
+
+LOGGER = logging.getLogger(__name__)
+
+# Take the lock if free, return the token of its holder
+_ACQUIRE = """
+local holder = redis.call('GET', KEYS[1])
+if holder then
+    return holder
+end
+redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+return ARGV[1]
+"""
+
+# Publish the result of a flight and release its lock, if still held
+_PUBLISH = """
+if ARGV[2] ~= '' then
+    redis.call('SET', KEYS[2], ARGV[2], 'PX', ARGV[3])
+end
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('DEL', KEYS[1])
+end
+return 1
+"""
+
+
+def _text(value):
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.payload = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent identical calls so only one of them runs.
+
+    Within a process, followers wait on the leader's in-flight call. Across
+    processes, leaders race for a Redis lock: the winner runs the call and
+    publishes its result, under a key of its own flight, for a few seconds;
+    the others wait for it instead of calling too. An uncontended call costs
+    two Redis round trips. The result is pickled once, and every caller,
+    leader included, unpickles its own copy: callers can keep mutating
+    what they receive.
+    """
+
+    def __init__(
+        self,
+        get_redis=None,
+        prefix="singleflight:",
+        lock_timeout=10,
+        result_ttl=5,
+        poll_interval=0.02,
+    ):
+        self.get_redis = get_redis
+        self.prefix = prefix
+        self.lock_timeout = lock_timeout
+        self.result_ttl = result_ttl
+        self.poll_interval = poll_interval
+
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._scripts = None
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return pickle.loads(call.payload)
+
+        try:
+            call.payload = self._do_shared(key, func)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+        return pickle.loads(call.payload)
+
+    def _get_scripts(self, client):
+        if self._scripts is None:
+            self._scripts = (
+                client.register_script(_ACQUIRE),
+                client.register_script(_PUBLISH),
+            )
+        return self._scripts
+
+    def _result_key(self, digest, token):
+        return "{0}result:{1}:{2}".format(self.prefix, digest, token)
+
+    def _do_shared(self, key, func):
+        """
+        Run func once across every process sharing the Redis server,
+        returning its pickled result
+        """
+        client = self.get_redis() if self.get_redis else None
+        if client is None:
+            return pickle.dumps(func())
+
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        lock_key = "{0}lock:{1}".format(self.prefix, digest)
+        token = uuid.uuid4().hex
+
+        try:
+            acquire, publish = self._get_scripts(client)
+            holder = acquire(
+                keys=[lock_key], args=[token, self.lock_timeout * 1000], client=client
+            )
+        except Exception:
+            LOGGER.exception("Single-flight lock unavailable, calling directly")
+            return pickle.dumps(func())
+
+        if _text(holder) == token:
+            payload = b""
+            try:
+                payload = pickle.dumps(func())
+                return payload
+            finally:
+                # Failed calls publish nothing: followers call themselves
+                try:
+                    publish(
+                        keys=[lock_key, self._result_key(digest, token)],
+                        args=[token, payload, self.result_ttl * 1000],
+                        client=client,
+                    )
+                except Exception:
+                    LOGGER.exception("Could not publish single-flight result")
+
+        # Another worker is calling: wait for the result of its flight while
+        # it holds the lock
+        holder = _text(holder)
+        result_key = self._result_key(digest, holder)
+        deadline = time.monotonic() + self.lock_timeout
+        while time.monotonic() < deadline:
+            try:
+                pipe = client.pipeline(transaction=False)
+                pipe.get(result_key)
+                pipe.get(lock_key)
+                payload, current = pipe.execute()
+                if payload is not None:
+                    return payload
+                if _text(current) != holder:
+                    # Leader failed or its result is gone, call ourselves
+                    break
+            except Exception:
+                LOGGER.exception("Single-flight wait failed, calling directly")
+                break
+            time.sleep(self.poll_interval)
+
+        return pickle.dumps(func())
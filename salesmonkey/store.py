@@ -0,0 +1,20 @@
+import redis
+
+from salesmonkey import app
+
+_redis = None
+
+
+def get_redis():
+    """
+    Return the Redis client shared by the app: the session one when
+    configured, otherwise a client built from REDIS_URL.
+    """
+    global _redis
+
+    if _redis is None:
+        _redis = app.config.get("SESSION_REDIS") or redis.Redis.from_url(
+            app.config.get("REDIS_URL", "redis://localhost:6379/0")
+        )
+
+    return _redis
@@ -0,0 +1,152 @@
+import logging
+import os
+import socket
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+
+LOGGER = logging.getLogger(__name__)
+
+
+class PooledTransportAdapter(HTTPAdapter):
+    """
+    HTTPAdapter keeping a bounded pool of keep-alive connections per worker,
+    applying default connect/read timeouts and counting pool saturation.
+    Its stats are logged every `log_every` requests of a worker (0: never).
+    """
+
+    def __init__(
+        self,
+        pool_maxsize=10,
+        pool_block=True,
+        connect_timeout=3.05,
+        read_timeout=30,
+        max_retries=0,
+        log_every=1000,
+    ):
+        self.timeout = (connect_timeout, read_timeout)
+        self.log_every = log_every
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._reset_stats()
+
+        super().__init__(
+            pool_connections=1,
+            pool_maxsize=pool_maxsize,
+            pool_block=pool_block,
+            max_retries=max_retries,
+        )
+
+    def _reset_stats(self):
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.requests = 0
+        self.saturated = 0
+        self.errors = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        # TCP keepalive so idle pooled connections survive NAT/load balancers
+        pool_kwargs.setdefault(
+            "socket_options",
+            HTTPConnection.default_socket_options
+            + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)],
+        )
+        super().init_poolmanager(connections, maxsize, block=block, **pool_kwargs)
+
+    def _check_fork(self):
+        """
+        Connections must never be shared between a master and its forked
+        workers: drop whatever was inherited and start a fresh pool.
+        """
+        pid = os.getpid()
+        if pid != self._pid:
+            with self._lock:
+                if pid != self._pid:
+                    self.poolmanager.clear()
+                    self._pid = pid
+                    self._reset_stats()
+
+    def send(self, request, timeout=None, **kwargs):
+        self._check_fork()
+
+        if timeout is None:
+            timeout = self.timeout
+
+        with self._lock:
+            self.requests += 1
+            if self.in_flight >= self._pool_maxsize:
+                self.saturated += 1
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+        start = time.perf_counter()
+        try:
+            return super().send(request, timeout=timeout, **kwargs)
+        except requests.RequestException:
+            with self._lock:
+                self.errors += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.in_flight -= 1
+                self.latency_total += elapsed
+                self.latency_max = max(self.latency_max, elapsed)
+                log_stats = self.log_every and self.requests % self.log_every == 0
+
+            if log_stats:
+                LOGGER.info("ERP transport stats: {0}".format(self.stats()))
+
+    def stats(self):
+        with self._lock:
+            return {
+                "pid": self._pid,
+                "pool_maxsize": self._pool_maxsize,
+                "in_flight": self.in_flight,
+                "peak_in_flight": self.peak_in_flight,
+                "requests": self.requests,
+                "saturated": self.saturated,
+                "errors": self.errors,
+                "latency_avg_ms": round(
+                    self.latency_total * 1000 / max(self.requests, 1), 1
+                ),
+                "latency_max_ms": round(self.latency_max * 1000, 1),
+            }
+
+
+def install_pooled_transport(client, config):
+    """
+    Mount a PooledTransportAdapter on the HTTP session of an ERPNextClient.
+    Must be called before the client logs in so the session cookie lives on
+    the pooled session.
+    """
+    adapter = PooledTransportAdapter(
+        pool_maxsize=config.get("ERPNEXT_POOL_MAXSIZE", 10),
+        pool_block=config.get("ERPNEXT_POOL_BLOCK", True),
+        connect_timeout=config.get("ERPNEXT_CONNECT_TIMEOUT", 3.05),
+        read_timeout=config.get("ERPNEXT_READ_TIMEOUT", 30),
+        max_retries=config.get("ERPNEXT_MAX_RETRIES", 0),
+        log_every=config.get("ERPNEXT_POOL_STATS_EVERY", 1000),
+    )
+
+    session = getattr(client, "session", None)
+    if session is None:
+        session = requests.Session()
+        client.session = session
+
+    session.headers.update({"Connection": "keep-alive"})
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    LOGGER.debug(
+        "Pooled ERP transport installed (maxsize={0}, timeouts={1})".format(
+            adapter._pool_maxsize, adapter.timeout
+        )
+    )
+
+    return adapter
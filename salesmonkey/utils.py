@@ -1,14 +1,23 @@
+from collections import OrderedDict
 from datetime import datetime
 import random
+import threading
+import time
 from base64 import b64encode
 import base64
+import functools
 import inspect
 import json
+import math
+import pickle
 
-from flask_caching import Cache
+from flask_caching import Cache, null_control, wants_args
 
 from hashlib import md5
 import hashlib
+import logging
+
+LOGGER = logging.getLogger(__name__)
 
 
 class OrderNumberGenerator:
@@ -32,11 +41,654 @@ class OrderNumberGenerator:
         return num
 
 
+class LRUCache:
+    """
+    Thread-safe in-process LRU cache with a time to live, bounded by a number
+    of entries and optionally by the total size (in bytes) of its values
+    """
+
+    def __init__(self, maxsize=1024, ttl=300, max_bytes=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+
+            value, expires_at, size = entry
+            if expires_at <= time.monotonic():
+                self._pop(key)
+                return default
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None, size=0):
+        if self.max_bytes is not None and size > self.max_bytes:
+            self.delete(key)
+            return
+
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._pop(key)
+            self._entries[key] = (value, expires_at, size)
+            self.size += size
+            while len(self._entries) > self.maxsize or (
+                self.max_bytes is not None and self.size > self.max_bytes
+            ):
+                self._pop(next(iter(self._entries)))
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+    def delete(self, key):
+        with self._lock:
+            self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class TwoTierCache:
+    """
+    Flask-Caching backend wrapper adding a per-process LRU (L1) in front of
+    the shared backend (L2).
+
+    L1 keeps serialized values so callers never share mutable objects, and
+    keeps them no longer than both CACHE_L1_TTL and their remaining L2 time
+    to live.
+    """
+
+    _missing = object()
+
+    def __init__(self, backend, max_bytes=8 * 1024 * 1024, ttl=5):
+        self.backend = backend
+        self.ttl = ttl
+        self.l1 = LRUCache(maxsize=100000, ttl=ttl, max_bytes=max_bytes)
+
+        self.l1_hits = 0
+        self.l2_hits = 0
+        self.misses = 0
+
+        # Redis backend: fetch the payload and its remaining TTL in one trip
+        self._redis = getattr(backend, "_read_clients", None)
+
+    def __getattr__(self, attr):
+        return getattr(self.backend, attr)
+
+    def _dump(self, value):
+        if self._redis is not None:
+            return self.backend.dump_object(value)
+        return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def _load(self, payload):
+        if self._redis is not None:
+            return self.backend.load_object(payload)
+        return pickle.loads(payload)
+
+    def _l1_ttl(self, timeout):
+        if timeout is None:
+            timeout = self.backend.default_timeout
+        if not timeout or timeout <= 0:
+            return self.ttl
+        return min(self.ttl, timeout)
+
+    def _fill(self, key, value, timeout):
+        if value is None:
+            return
+        payload = self._dump(value)
+        self.l1.set(key, payload, ttl=self._l1_ttl(timeout), size=len(payload))
+
+    def _get_l2(self, keys):
+        """
+        Return {key: (payload, ttl)} for the keys found in L2
+        """
+        found = {}
+        if self._redis is not None:
+            prefix = self.backend._get_prefix()
+            pipe = self._redis.pipeline(transaction=False)
+            for key in keys:
+                pipe.get(prefix + key)
+                pipe.pttl(prefix + key)
+            replies = pipe.execute()
+            for key, payload, pttl in zip(keys, replies[::2], replies[1::2]):
+                if payload is not None:
+                    ttl = pttl / 1000.0 if pttl and pttl > 0 else None
+                    found[key] = (payload, ttl)
+        else:
+            for key, value in zip(keys, self.backend.get_many(*keys)):
+                if value is not None:
+                    found[key] = (self._dump(value), None)
+        return found
+
+    def get(self, key):
+        return self.get_many(key)[0]
+
+    def get_many(self, *keys):
+        values = {}
+        l2_keys = []
+        for key in keys:
+            payload = self.l1.get(key, self._missing)
+            if payload is self._missing:
+                l2_keys.append(key)
+            else:
+                self.l1_hits += 1
+                values[key] = self._load(payload)
+
+        if l2_keys:
+            found = self._get_l2(l2_keys)
+            for key in l2_keys:
+                if key not in found:
+                    self.misses += 1
+                    continue
+                self.l2_hits += 1
+                payload, ttl = found[key]
+                self.l1.set(key, payload, ttl=self._l1_ttl(ttl), size=len(payload))
+                values[key] = self._load(payload)
+
+        return [values.get(key) for key in keys]
+
+    def get_dict(self, *keys):
+        return dict(zip(keys, self.get_many(*keys)))
+
+    def has(self, key):
+        return self.l1.get(key, self._missing) is not self._missing or (
+            self.backend.has(key)
+        )
+
+    def set(self, key, value, timeout=None):
+        rv = self.backend.set(key, value, timeout=timeout)
+        self._fill(key, value, timeout)
+        return rv
+
+    def add(self, key, value, timeout=None):
+        rv = self.backend.add(key, value, timeout=timeout)
+        if rv:
+            self._fill(key, value, timeout)
+        return rv
+
+    def set_many(self, mapping, timeout=None):
+        rv = self.backend.set_many(mapping, timeout=timeout)
+        for key, value in mapping.items():
+            self._fill(key, value, timeout)
+        return rv
+
+    def delete(self, key):
+        self.l1.delete(key)
+        return self.backend.delete(key)
+
+    def delete_many(self, *keys):
+        for key in keys:
+            self.l1.delete(key)
+        return self.backend.delete_many(*keys)
+
+    def unlink(self, *keys):
+        for key in keys:
+            self.l1.delete(key)
+        unlink = getattr(self.backend, "unlink", self.backend.delete_many)
+        return unlink(*keys)
+
+    def inc(self, key, delta=1):
+        self.l1.delete(key)
+        return self.backend.inc(key, delta=delta)
+
+    def dec(self, key, delta=1):
+        self.l1.delete(key)
+        return self.backend.dec(key, delta=delta)
+
+    def clear(self):
+        self.l1.clear()
+        return self.backend.clear()
+
+    def stats(self):
+        return {
+            "l1_hits": self.l1_hits,
+            "l2_hits": self.l2_hits,
+            "misses": self.misses,
+            "l1_entries": len(self.l1),
+            "l1_bytes": self.l1.size,
+        }
+
+
 class ResourceCache(Cache):
     """
     A customized version of Cache that works with FlaskApiSpec Resources (removes self arg)
+
+    Set CACHE_L1_MAX_BYTES to serve hot entries from a per-process LRU before
+    reaching the configured backend (see TwoTierCache), and CACHE_KEY_HASH to
+    pick the hashlib function used to build memoize keys.
     """
 
+    def __init__(self, *args, **kwargs):
+        self._key_specs = {}
+        self.key_hash = hashlib.md5
+        self.refresh_lock_timeout = 60
+        self.lock_poll_interval = 0.05
+        self.tag_timeout = 60 * 60 * 48
+
+        super().__init__(*args, **kwargs)
+
+    def _set_cache(self, app, config):
+        super()._set_cache(app, config)
+
+        self.key_hash = _hash_method(app.config.get("CACHE_KEY_HASH", "md5"))
+        self.refresh_lock_timeout = app.config.get("CACHE_REFRESH_LOCK_TIMEOUT", 60)
+        self.lock_poll_interval = app.config.get("CACHE_LOCK_POLL_INTERVAL", 0.05)
+        self.tag_timeout = app.config.get("CACHE_TAG_TIMEOUT", 60 * 60 * 48)
+
+        max_bytes = app.config.get("CACHE_L1_MAX_BYTES")
+        if max_bytes:
+            app.extensions["cache"][self] = TwoTierCache(
+                app.extensions["cache"][self],
+                max_bytes=max_bytes,
+                ttl=app.config.get("CACHE_L1_TTL", 5),
+            )
+
+    def stats(self):
+        stats = getattr(self.cache, "stats", None)
+        return stats() if stats else {}
+
+    def memoize(
+        self,
+        timeout=None,
+        make_name=None,
+        unless=None,
+        forced_update=None,
+        response_filter=None,
+        hash_method=hashlib.md5,
+        cache_none=False,
+        stale_ttl=None,
+        lock=False,
+        xfetch_beta=None,
+        tags=None,
+    ):
+        """
+        Cache.memoize with stale-while-revalidate, stampede protection and
+        tag based invalidation.
+
+        :param stale_ttl: Default None. If set, an entry is kept `stale_ttl`
+                          seconds past its timeout: callers get the stale
+                          value at once while a single background call
+                          refreshes it.
+        :param lock: Default False. If True, a single worker computes a
+                     missing entry while the others wait for its result.
+        :param xfetch_beta: Default None. If set, entries are recomputed in
+                            the background before they expire, with a
+                            probability growing as expiry gets closer and
+                            as the function gets slower (XFetch). 1.0 is a
+                            good start, higher values recompute earlier.
+        :param tags: Default None. Tags (see doc_tag) of the documents an
+                     entry depends on, so delete_tagged() can purge it: a
+                     list, or a callable given the result and the call
+                     arguments returning one.
+        """
+        if not (stale_ttl or lock or xfetch_beta or tags):
+            return super().memoize(
+                timeout=timeout,
+                make_name=make_name,
+                unless=unless,
+                forced_update=forced_update,
+                response_filter=response_filter,
+                hash_method=hash_method,
+                cache_none=cache_none,
+            )
+
+        def memoize(f):
+            @functools.wraps(f)
+            def decorated_function(*args, **kwargs):
+                #: bypass cache
+                if self._bypass_cache(unless, f, *args, **kwargs):
+                    return f(*args, **kwargs)
+
+                try:
+                    cache_key = decorated_function.make_cache_key(f, *args, **kwargs)
+
+                    if callable(forced_update) and (
+                        forced_update(*args, **kwargs)
+                        if wants_args(forced_update)
+                        else forced_update()
+                    ):
+                        entry = None
+                    else:
+                        entry = self.cache.get(cache_key)
+                except Exception:
+                    if self.app.debug:
+                        raise
+                    LOGGER.exception("Exception possibly due to cache backend.")
+                    return f(*args, **kwargs)
+
+                if entry is None:
+                    if lock:
+                        return self._memoize_call_locked(
+                            decorated_function, cache_key, f, args, kwargs
+                        )
+                    return self._memoize_call(
+                        decorated_function, cache_key, f, args, kwargs
+                    )
+
+                value, fresh_until, delta = entry
+                now = time.time()
+                if now >= fresh_until or (
+                    xfetch_beta
+                    and now - delta * xfetch_beta * math.log(1 - random.random())
+                    >= fresh_until
+                ):
+                    self._memoize_refresh(
+                        decorated_function, cache_key, f, args, kwargs
+                    )
+
+                return value
+
+            decorated_function.uncached = f
+            decorated_function.cache_timeout = timeout
+            decorated_function.stale_ttl = stale_ttl
+            decorated_function.tags = tags
+            decorated_function.response_filter = response_filter
+            decorated_function.make_cache_key = self._memoize_make_cache_key(
+                make_name=make_name,
+                timeout=decorated_function,
+                forced_update=forced_update,
+                hash_method=hash_method,
+            )
+            decorated_function.delete_memoized = lambda: self.delete_memoized(f)
+
+            return decorated_function
+
+        return memoize
+
+    def _memoize_call(self, decorated_function, cache_key, f, args, kwargs):
+        """
+        Call f and store its result, see _memoize_store
+        """
+        start = time.time()
+        rv = f(*args, **kwargs)
+        self._memoize_store(
+            decorated_function, cache_key, rv, args, kwargs, time.time() - start
+        )
+
+        return rv
+
+    def _memoize_store(self, decorated_function, cache_key, rv, args, kwargs, delta):
+        """
+        Store a result in a (value, fresh_until, delta) entry kept stale_ttl
+        seconds longer than the function timeout, delta being how long the
+        call took
+        """
+        response_filter = decorated_function.response_filter
+        if response_filter is not None and not response_filter(rv):
+            return
+
+        timeout = decorated_function.cache_timeout
+        if timeout is None:
+            timeout = self.cache.default_timeout
+
+        now = time.time()
+        if timeout:
+            fresh_until = now + timeout
+            timeout += decorated_function.stale_ttl or 0
+        else:
+            fresh_until = float("inf")
+
+        try:
+            self.cache.set(cache_key, (rv, fresh_until, delta), timeout=timeout)
+
+            tags = decorated_function.tags
+            if callable(tags):
+                tags = tags(rv, *args, **kwargs)
+            if tags:
+                self._tag_key(cache_key, tags)
+        except Exception:
+            if self.app.debug:
+                raise
+            LOGGER.exception("Exception possibly due to cache backend.")
+
+    def _memoize_call_locked(self, decorated_function, cache_key, f, args, kwargs):
+        """
+        Compute a missing entry in a single worker, the others wait for it
+        and only call f themselves if it does not show up in time
+        """
+        lock_key = cache_key + "_lock"
+        try:
+            acquired = self.cache.add(lock_key, 1, timeout=self.refresh_lock_timeout)
+        except Exception:
+            LOGGER.exception("Exception possibly due to cache backend.")
+            acquired = True
+
+        if acquired:
+            try:
+                return self._memoize_call(
+                    decorated_function, cache_key, f, args, kwargs
+                )
+            finally:
+                try:
+                    self.cache.delete(lock_key)
+                except Exception:
+                    LOGGER.exception("Exception possibly due to cache backend.")
+
+        deadline = time.monotonic() + self.refresh_lock_timeout
+        while time.monotonic() < deadline:
+            time.sleep(self.lock_poll_interval)
+            try:
+                entry = self.cache.get(cache_key)
+                if entry is not None:
+                    return entry[0]
+                if not self.cache.has(lock_key):
+                    break
+            except Exception:
+                LOGGER.exception("Exception possibly due to cache backend.")
+                break
+
+        return self._memoize_call(decorated_function, cache_key, f, args, kwargs)
+
+    def _memoize_refresh(self, decorated_function, cache_key, f, args, kwargs):
+        """
+        Refresh an entry in the background, once across all workers
+        """
+        lock_key = cache_key + "_refresh"
+        try:
+            if not self.cache.add(lock_key, 1, timeout=self.refresh_lock_timeout):
+                return
+        except Exception:
+            LOGGER.exception("Exception possibly due to cache backend.")
+            return
+
+        def refresh():
+            try:
+                self._memoize_call(decorated_function, cache_key, f, args, kwargs)
+            except Exception:
+                LOGGER.exception("Background refresh of <{0}> failed".format(f))
+            finally:
+                try:
+                    self.cache.delete(lock_key)
+                except Exception:
+                    LOGGER.exception("Exception possibly due to cache backend.")
+
+        # Imported here so utils stays loadable on its own (see benchmarks)
+        from .fanout import submit
+
+        submit(refresh)
+
+    def memoized_many(self, decorated_function, args_list, fetch_many):
+        """
+        Results of a function memoized with the options of this memoize
+        (stale_ttl, lock, xfetch_beta or tags) for many calls at once.
+
+        Cached results are read with a single get_many. The missing ones come
+        from one fetch_many(missing_args_list) call returning a dict keyed by
+        args tuple, and are stored as if decorated_function had been called,
+        warming its per-call entries in bulk. Returns {args: result} for
+        every args tuple of args_list fetch_many could resolve.
+        """
+        if not hasattr(decorated_function, "tags"):
+            raise ValueError(
+                "{0} is not memoized with ResourceCache options".format(
+                    decorated_function
+                )
+            )
+
+        f = decorated_function.uncached
+        args_list = list(dict.fromkeys(args_list))
+        results = {}
+
+        try:
+            cache_keys = {
+                args: decorated_function.make_cache_key(f, *args) for args in args_list
+            }
+            entries = self.cache.get_many(*cache_keys.values())
+        except Exception:
+            if self.app.debug:
+                raise
+            LOGGER.exception("Exception possibly due to cache backend.")
+            cache_keys = {}
+            entries = [None] * len(args_list)
+
+        missing = []
+        for args, entry in zip(args_list, entries):
+            if entry is None:
+                missing.append(args)
+            else:
+                results[args] = entry[0]
+
+        if not missing:
+            return results
+
+        start = time.time()
+        fetched = fetch_many(missing)
+        delta = (time.time() - start) / len(missing)
+
+        for args in missing:
+            if args not in fetched:
+                continue
+            rv = results[args] = fetched[args]
+            if args in cache_keys:
+                self._memoize_store(
+                    decorated_function, cache_keys[args], rv, args, {}, delta
+                )
+
+        return results
+
+    def _tag_index(self):
+        """
+        Redis client and key prefix when the backend is Redis, None otherwise
+        """
+        client = getattr(self.cache, "_write_client", None)
+        if client is None:
+            return None, None
+        return client, self.cache._get_prefix() + "tag:"
+
+    def _tag_key(self, cache_key, tags):
+        client, prefix = self._tag_index()
+        if client is not None:
+            pipe = client.pipeline(transaction=False)
+            for tag in tags:
+                pipe.sadd(prefix + tag, cache_key)
+                pipe.expire(prefix + tag, self.tag_timeout)
+            pipe.execute()
+            return
+
+        # Other backends (development): non atomic index inside the cache
+        for tag in tags:
+            keys = self.cache.get("tag:" + tag) or set()
+            keys.add(cache_key)
+            self.cache.set("tag:" + tag, keys, timeout=self.tag_timeout)
+
+    def delete_tagged(self, *tags):
+        """
+        Delete every memoized entry tagged with one of tags, returns how many
+        keys were deleted. Other workers L1 copies expire on their own within
+        CACHE_L1_TTL.
+        """
+        client, prefix = self._tag_index()
+        keys = set()
+        for tag in tags:
+            if client is not None:
+                members = client.smembers(prefix + tag)
+                keys.update(member.decode("utf-8") for member in members)
+                client.delete(prefix + tag)
+            else:
+                keys.update(self.cache.get("tag:" + tag) or ())
+                self.cache.delete("tag:" + tag)
+
+        if keys:
+            self.cache.delete_many(*keys)
+
+        LOGGER.debug("Purged {0} cache entries for tags {1}".format(len(keys), tags))
+
+        return len(keys)
+
+    def _key_spec(self, f):
+        spec = self._key_specs.get(f)
+        if spec is None:
+            spec = self._key_specs[f] = MemoizeKeySpec(f)
+        return spec
+
+    def _memoize_version(
+        self,
+        f,
+        args=None,
+        kwargs=None,
+        reset=False,
+        delete=False,
+        timeout=None,
+        forced_update=False,
+    ):
+        """
+        Same as Cache._memoize_version with a single version key per
+        function: resource instances only live for one request, so there is
+        no point in versioning them separately.
+        """
+        fname = self._key_spec(f).fname
+        version_key = self._memvname(fname)
+
+        if delete:
+            self.cache.delete_many(version_key)
+            return fname, None
+
+        dirty = False
+        if reset:
+            version_data = None
+        else:
+            version_data = self.cache.get(version_key)
+
+            if (
+                callable(forced_update)
+                and (
+                    forced_update(*(args or ()), **(kwargs or {}))
+                    if wants_args(forced_update)
+                    else forced_update()
+                )
+                is True
+            ):
+                # Mark key as dirty to update its TTL
+                dirty = True
+
+        if version_data is None and not reset:
+            # Concurrent first calls must agree on a single version
+            version_data = self._memoize_make_version_hash()
+            if not self.cache.add(version_key, version_data, timeout=timeout):
+                version_data = self.cache.get(version_key) or version_data
+        elif version_data is None:
+            version_data = self._memoize_make_version_hash()
+            dirty = True
+
+        if dirty:
+            self.cache.set(version_key, version_data, timeout=timeout)
+
+        return fname, version_data
+
     def _memoize_make_cache_key(
         self,
         make_name=None,
@@ -47,28 +699,26 @@ class ResourceCache(Cache):
         """Function used to create the cache_key for memoized functions."""
 
         def make_cache_key(f, *args, **kwargs):
+            spec = self._key_spec(f)
+
             _timeout = getattr(timeout, "cache_timeout", timeout)
+            if _timeout and getattr(timeout, "stale_ttl", None):
+                # Version must outlive the stale entries
+                _timeout += timeout.stale_ttl
             fname, version_data = self._memoize_version(
-                f,
-                args=self._extract_self_arg(f, args),
-                timeout=_timeout,
-                forced_update=forced_update,
+                f, args=args, timeout=_timeout, forced_update=forced_update
             )
 
             #: this should have to be after version_data, so that it
             #: does not break the delete_memoized functionality.
-            altfname = make_name(fname) if callable(make_name) else f
+            altfname = make_name(fname) if callable(make_name) else fname
 
-            if callable(f):
-                keyargs, keykwargs = self._memoize_kwargs_to_args(f, *args, **kwargs)
-            else:
-                keyargs, keykwargs = args, kwargs
+            updated = altfname + spec.key_args(args, kwargs)
 
-            updated = u"{0}{1}{2}".format(
-                altfname, self._extract_self_arg(f, keyargs), keykwargs
-            )
-
-            cache_key = hash_method()
+            if hash_method is hashlib.md5:
+                cache_key = self.key_hash()
+            else:
+                cache_key = hash_method()
             cache_key.update(updated.encode("utf-8"))
             cache_key = base64.b64encode(cache_key.digest())[:16]
             cache_key = cache_key.decode("utf-8")
@@ -78,12 +728,82 @@ class ResourceCache(Cache):
 
         return make_cache_key
 
+
+class MemoizeKeySpec:
+    """
+    Argument metadata of a memoized function, inspected once instead of on
+    every call
+    """
+
+    SIMPLE_TYPES = frozenset((str, int, float, bool, type(None)))
+
+    def __init__(self, f):
+        params = [
+            param
+            for param in inspect.signature(f).parameters.values()
+            if param.kind == param.POSITIONAL_OR_KEYWORD
+        ]
+
+        self.arg_names = [param.name for param in params]
+        self.defaults = [
+            None if param.default is param.empty else param.default for param in params
+        ]
+        self.has_self = bool(self.arg_names) and self.arg_names[0] in ("self", "cls")
+        self.fname = ".".join((f.__module__, f.__qualname__)).translate(*null_control)
+
     @staticmethod
-    def _extract_self_arg(f, args):
-        argspec_args = inspect.getargspec(f).args
-
-        if argspec_args and argspec_args[0] in ("self", "cls"):
-            if hasattr(args[0], "__name__"):
-                return (args[0].__name__,) + args[1:]
-            return (args[0].__class__.__name__,) + args[1:]
-        return args
+    def self_token(obj):
+        # Resources are instantiated per request: key on their class
+        if hasattr(obj, "__name__"):
+            return obj.__name__
+        return obj.__class__.__name__
+
+    def key_args(self, args, kwargs):
+        """
+        Text identifying a call, the same whether arguments were given
+        positionally or by keyword
+        """
+        if self.has_self and args:
+            args = (self.self_token(args[0]),) + args[1:]
+
+        # Fast path: every argument given positionally as a plain value
+        if not kwargs and len(args) == len(self.arg_names):
+            simple_types = self.SIMPLE_TYPES
+            if all(type(arg) in simple_types for arg in args):
+                return repr(args)
+
+        new_args = []
+        remaining = dict(kwargs)
+        arg_num = 0
+        for name, default in zip(self.arg_names, self.defaults):
+            if name in remaining:
+                new_args.append(remaining.pop(name))
+            elif arg_num < len(args):
+                new_args.append(args[arg_num])
+                arg_num += 1
+            else:
+                new_args.append(default)
+                arg_num += 1
+        new_args.extend(args[len(self.arg_names) :])
+
+        if remaining:
+            return repr(tuple(new_args)) + repr(sorted(remaining.items()))
+        return repr(tuple(new_args))
+
+
+def doc_tag(doctype, name=None):
+    """
+    Cache tag of an ERP document, or of a whole doctype when name is None
+    """
+    if name is None:
+        return doctype
+    return "{0}:{1}".format(doctype, name)
+
+
+def _hash_method(name):
+    """
+    hashlib constructor for CACHE_KEY_HASH, digests are truncated anyway
+    """
+    if name in ("blake2b", "blake2s"):
+        return functools.partial(getattr(hashlib, name), digest_size=16)
+    return getattr(hashlib, name)
@@ -0,0 +1,3 @@
+from . import rest
+
+__all__ = [rest]
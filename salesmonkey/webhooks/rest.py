@@ -0,0 +1,103 @@
+import base64
+import hashlib
+import hmac
+import logging
+from collections import defaultdict
+
+from flask import jsonify, request
+from werkzeug.exceptions import BadRequest, Unauthorized
+
+from flask_apispec import MethodResource
+
+from salesmonkey import app, cache
+
+from ..rest import api_v1
+from ..utils import doc_tag
+
+LOGGER = logging.getLogger(__name__)
+
+_change_listeners = defaultdict(list)
+
+
+def on_document_change(doctype):
+    """
+    Register a function called with the document of every webhook received
+    for `doctype`, once its cache entries are purged
+    """
+
+    def register(func):
+        _change_listeners[doctype].append(func)
+        return func
+
+    return register
+
+
+def document_tags(document):
+    """
+    Cache tags touched by a change of the given ERP document
+    """
+    doctype = document["doctype"]
+
+    tags = [doc_tag(doctype), doc_tag(doctype, document["name"])]
+
+    # Bins and Item Prices are tagged by item
+    if document.get("item_code"):
+        tags.append(doc_tag(doctype, document["item_code"]))
+
+    # A variant change shows on its template
+    if document.get("variant_of"):
+        tags.append(doc_tag("Item", document["variant_of"]))
+
+    return tags
+
+
+class ERPWebhook(MethodResource):
+    """
+    Receive ERPNext document change notifications (Webhook doctype, with
+    "Enable Security") and purge every cache entry depending on the document
+    """
+
+    def _check_signature(self):
+        secret = app.config.get("ERPNEXT_WEBHOOK_SECRET")
+        if not secret:
+            raise Unauthorized
+
+        signature = base64.b64encode(
+            hmac.new(
+                secret.encode("utf-8"), request.get_data(), hashlib.sha256
+            ).digest()
+        ).decode("ascii")
+
+        if not hmac.compare_digest(
+            signature, request.headers.get("X-Frappe-Webhook-Signature", "")
+        ):
+            raise Unauthorized
+
+    def post(self):
+        self._check_signature()
+
+        document = request.get_json(force=True, silent=True) or {}
+        if not (document.get("doctype") and document.get("name")):
+            raise BadRequest("doctype and name are required")
+
+        tags = document_tags(document)
+        purged = cache.delete_tagged(*tags)
+
+        LOGGER.info(
+            "ERP change on {0} <{1}> purged {2} cache entries".format(
+                document["doctype"], document["name"], purged
+            )
+        )
+
+        for listener in _change_listeners[document["doctype"]]:
+            try:
+                listener(document)
+            except Exception:
+                LOGGER.exception(
+                    "Change listener {0} failed".format(listener.__qualname__)
+                )
+
+        return jsonify(purged=purged)
+
+
+api_v1.register("/erp/webhook", ERPWebhook, session=False)
@@ -0,0 +1,54 @@
+import importlib.util
+import os
+import threading
+import time
+
+# Load the module without importing the salesmonkey package (needs settings.cfg)
+spec = importlib.util.spec_from_file_location(
+    "salesmonkey_singleflight",
+    os.path.join(os.path.dirname(__file__), "..", "salesmonkey", "singleflight.py"),
+)
+singleflight = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(singleflight)
+
+
+def test_callers_get_private_copies_while_leader_mutates():
+    single_flight = singleflight.SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        release.wait(5)
+        return {"name": "TRIP-1", "stops": [{"contact": "C-1"}] * 50}
+
+    def leader():
+        trip = single_flight.do("trip", fetch)
+        # Mutate the result while followers are still being served
+        for idx in range(10000):
+            trip["extra-{0}".format(idx)] = idx
+            trip["stops"][0]["contact"] = {"name": "C-1"}
+
+    follower_results = []
+
+    def follower():
+        follower_results.append(single_flight.do("trip", fetch))
+
+    leader_thread = threading.Thread(target=leader)
+    leader_thread.start()
+    time.sleep(0.05)
+    followers = [threading.Thread(target=follower) for _ in range(5)]
+    for thread in followers:
+        thread.start()
+    time.sleep(0.05)
+    release.set()
+
+    leader_thread.join()
+    for thread in followers:
+        thread.join()
+
+    assert len(calls) == 1
+    assert len(follower_results) == 5
+    for result in follower_results:
+        assert result == {"name": "TRIP-1", "stops": [{"contact": "C-1"}] * 50}
+    assert len({id(result) for result in follower_results}) == 5